@@ -1,184 +1,1852 @@
+import bisect
+import collections
+import contextlib
+import cProfile
+import csv
 import datetime
+import functools
+import io
+import itertools
+import json
+import math
+import mmap
+import os
+import pstats
 import re
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import (FileLock, PartitionedRecordFile, RecordFile, RecordJournal, SQLiteRecordStorage, append_lines,
+                     atomic_write, file_signature, format_record_line, matching_lines, parse_timestamp, read_record_lines,
+                     record_key)
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# Pattern to match >value, <value, or >value,<value in any order
+RANGE_PATTERN = re.compile(r'^((>(-?\d+(\.\d+)?))?(,(<(-?\d+(\.\d+)?)))?|((<(-?\d+(\.\d+)?))?(,(>(-?\d+(\.\d+)?)))?))$')
+LOWER_LIMIT_PATTERN = re.compile(r'>(-?\d+(\.\d+)?)')
+UPPER_LIMIT_PATTERN = re.compile(r'<(-?\d+(\.\d+)?)')
+RESULT_PATTERN = re.compile(r'-?\d+(\.\d+)?')
+VALID_STATUSES = frozenset(('pending', 'completed', 'reviewed'))
+
+PARALLEL_SCAN_MIN_BYTES = 4 << 20
+
+
+def format_result(value):
+	text = repr(value)
+	return text[:-2] if text.endswith('.0') else text
+
+
+class PatientRecord:
+	# One parsed line of the record file; __slots__ keeps resident records small. result_text is the result
+	# as written in the line, so to_line gives the line back as stored
+	__slots__ = ('patient_id', 'test_name', 'test_date', 'result', 'unit', 'status', 'result_date', 'result_text')
+
+	def __init__(self, patient_id, test_name, test_date, result, unit, status, result_date=None, result_text=None):
+		self.patient_id = patient_id
+		self.test_name = test_name
+		self.test_date = test_date
+		self.result = result
+		self.unit = unit
+		self.status = status
+		self.result_date = result_date
+		self.result_text = result_text
+
+	@classmethod
+	def parse(cls, line):
+		parts = line.split(', ')
+		patient_id, test_name = parts[0].split(': ', 1)
+		return cls(patient_id, test_name, parse_timestamp(parts[1]), float(parts[2]), parts[3], parts[4],
+		           parse_timestamp(parts[5]) if len(parts) > 5 else None, parts[2])
+
+	@property
+	def key(self):
+		return self.patient_id, self.test_name
+
+	@property
+	def formatted_result(self):
+		return self.result_text if self.result_text is not None else format_result(self.result)
+
+	def to_line(self):
+		return format_record_line(self.patient_id, self.test_name, self.test_date.strftime('%Y-%m-%d %H:%M:%S'),
+		                          self.formatted_result, self.unit, self.status,
+		                          self.result_date.strftime('%Y-%m-%d %H:%M:%S') if self.result_date else None)
+
+	def __str__(self):
+		return self.to_line()
+
+	def __repr__(self):
+		return f"PatientRecord({self.to_line()!r})"
+
+	def __eq__(self, other):
+		if not isinstance(other, PatientRecord):
+			return NotImplemented
+		return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+	def __getstate__(self):
+		return tuple(getattr(self, name) for name in self.__slots__)
+
+	def __setstate__(self, state):
+		for name, value in zip(self.__slots__, state):
+			setattr(self, name, value)
+
+
+def parse_turnaround_time(ta_time):
+	try:
+		days, hours, minutes = map(int, ta_time.split('-'))
+	except ValueError:
+		return None
+	return datetime.timedelta(days=days, hours=hours, minutes=minutes)
+
+
+class TestDefinition:
+	# A medicalTest.txt entry with its range and turnaround time parsed once
+	__slots__ = ('name', 'range', 'unit', 'turnaround_time', 'bounds', 'turnaround')
+
+	def __init__(self, name, range_str, unit, turnaround_time):
+		self.name = name
+		self.range = range_str
+		self.unit = unit
+		self.turnaround_time = turnaround_time
+		self.bounds = ReferenceRange.parse(range_str)
+		self.turnaround = parse_turnaround_time(turnaround_time)
+
+	def to_line(self):
+		return f"{self.name};{self.range};{self.unit};{self.turnaround_time}"
+
+	def __getstate__(self):
+		return self.name, self.range, self.unit, self.turnaround_time
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+
+class ReferenceRange:
+	# A test's normal range compiled once from its '>x,<y' string
+	def __init__(self, lower=None, upper=None):
+		self.lower = lower
+		self.upper = upper
+
+	@classmethod
+	def parse(cls, range_str):
+		if not RANGE_PATTERN.match(range_str):
+			return None
+		lower = LOWER_LIMIT_PATTERN.search(range_str)
+		upper = UPPER_LIMIT_PATTERN.search(range_str)
+		return cls(float(lower.group(1)) if lower else None, float(upper.group(1)) if upper else None)
+
+	def is_abnormal(self, value):
+		return (self.lower is not None and value <= self.lower) or (self.upper is not None and value >= self.upper)
+
+	def classify(self, values):
+		lower, upper = self.lower, self.upper
+		if lower is None and upper is None:
+			return [False] * len(values)
+		if lower is None:
+			return [value >= upper for value in values]
+		if upper is None:
+			return [value <= lower for value in values]
+		return [value <= lower or value >= upper for value in values]
+
+
+class RecordStore:
+	# Keeps every record resident and indexed so lookups don't rescan the record file
+	def __init__(self):
+		self.records = []
+		self.by_patient = {}
+		self.by_test = {}
+		self.by_key = {}
+
+	@classmethod
+	def load(cls, lines):
+		store = cls()
+		for line in lines:
+			store.add(PatientRecord.parse(line))
+		return store
+
+	def add(self, record):
+		position = len(self.records)
+		self.records.append(record)
+		self.by_patient.setdefault(record.patient_id, []).append(position)
+		self.by_test.setdefault(record.test_name, []).append(position)
+		self.by_key.setdefault(record.key, []).append(position)
+
+	def exists(self, patient_id, test_name):
+		return (patient_id, test_name) in self.by_key
+
+	def find(self, patient_id=None, test_name=None):
+		if patient_id and test_name:
+			positions = self.by_key.get((patient_id, test_name), [])
+		elif patient_id:
+			positions = self.by_patient.get(patient_id, [])
+		elif test_name:
+			positions = self.by_test.get(test_name, [])
+		else:
+			return [record for record in self.records if record is not None]
+		return [self.records[position] for position in positions]
+
+	def replace(self, patient_id, test_name, line):
+		positions = self.by_key.get((patient_id, test_name), [])
+		for position in positions:
+			self.records[position] = PatientRecord.parse(line)
+		return len(positions)
+
+	def remove(self, patient_id, test_name):
+		positions = self.by_key.pop((patient_id, test_name), [])
+		for position in positions:
+			self.records[position] = None
+			self.by_patient[patient_id].remove(position)
+			self.by_test[test_name].remove(position)
+		if patient_id in self.by_patient and not self.by_patient[patient_id]:
+			del self.by_patient[patient_id]
+		if test_name in self.by_test and not self.by_test[test_name]:
+			del self.by_test[test_name]
+		return len(positions)
+
+
+class GroupCommitWriter:
+	# Batches appends from many threads: a caller that finds no flush in progress writes every pending
+	# line with one call to write_lines (one fsync), while the others wait for the batch holding theirs
+	def __init__(self, write_lines):
+		self.write_lines = write_lines
+		self.condition = threading.Condition()
+		self.pending = []
+		self.flushing = False
+		self.batch = 0
+		self.committed = -1
+		self.failures = {}
+
+	def append(self, line):
+		self.append_many([line])
+
+	def append_many(self, lines):
+		with self.condition:
+			self.pending.extend(lines)
+			batch = self.batch
+			while self.committed < batch:
+				if self.flushing:
+					self.condition.wait()
+					continue
+				self.flushing = True
+				flushed, lines, self.pending = self.batch, self.pending, []
+				self.batch += 1
+				self.condition.release()
+				try:
+					self.write_lines(lines)
+				except Exception as e:
+					self.failures[flushed] = e
+				finally:
+					self.condition.acquire()
+					self.flushing = False
+					self.committed = flushed
+					self.condition.notify_all()
+			if batch in self.failures:
+				raise self.failures[batch]
+
+
+class PatientTimelineCache:
+	# LRU of per-patient record lists sorted by test date, bounded by patient count and an
+	# estimated memory budget; the whole cache is dropped when the storage signature changes
+	def __init__(self, max_patients=1000, max_bytes=64 << 20):
+		self.max_patients = max_patients
+		self.max_bytes = max_bytes
+		self.timelines = collections.OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.signature = None
+		self.lock = threading.RLock()
+
+	@staticmethod
+	def estimate_size(timeline):
+		size = sys.getsizeof(timeline)
+		for record in timeline:
+			size += sys.getsizeof(record) + sum(sys.getsizeof(getattr(record, name)) for name in record.__slots__)
+		return size
+
+	def get(self, patient_id, signature):
+		with self.lock:
+			if signature != self.signature:
+				self.clear()
+				self.signature = signature
+			entry = self.timelines.get(patient_id)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.timelines.move_to_end(patient_id)
+			self.hits += 1
+			return entry[0]
+
+	def put(self, patient_id, timeline):
+		size = self.estimate_size(timeline)
+		with self.lock:
+			self.invalidate(patient_id)
+			if size > self.max_bytes:
+				return
+			self.timelines[patient_id] = (timeline, size)
+			self.bytes += size
+			while len(self.timelines) > self.max_patients or self.bytes > self.max_bytes:
+				_, (_, evicted_size) = self.timelines.popitem(last=False)
+				self.bytes -= evicted_size
+
+	def invalidate(self, patient_id):
+		with self.lock:
+			entry = self.timelines.pop(patient_id, None)
+			if entry is not None:
+				self.bytes -= entry[1]
+
+	def clear(self):
+		with self.lock:
+			self.timelines.clear()
+			self.bytes = 0
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'patients': len(self.timelines), 'bytes': self.bytes}
+
+
+class RecordTable:
+	# Column-oriented copy of the records for vectorised filtering and summaries (needs numpy). Strings are
+	# int32 codes into per-column name tables; a table loaded from a snapshot rebuilds records only for the
+	# rows select() returns
+	STRING_COLUMNS = ('patients', 'tests', 'units', 'statuses', 'texts')
+
+	def __init__(self, records=()):
+		if np is None:
+			raise ImportError("RecordTable requires numpy")
+		self.patient_codes, self.test_codes, self.unit_codes, self.status_codes, self.text_codes = {}, {}, {}, {}, {}
+		patients, tests, units, statuses, texts, values, test_dates, result_dates = [], [], [], [], [], [], [], []
+		self.records = []
+		for record in records:
+			patients.append(self.patient_codes.setdefault(record.patient_id, len(self.patient_codes)))
+			tests.append(self.test_codes.setdefault(record.test_name, len(self.test_codes)))
+			units.append(self.unit_codes.setdefault(record.unit, len(self.unit_codes)))
+			statuses.append(self.status_codes.setdefault(record.status, len(self.status_codes)))
+			texts.append(self.text_codes.setdefault(record.formatted_result, len(self.text_codes)))
+			values.append(record.result)
+			test_dates.append(record.test_date)
+			result_dates.append(record.result_date)
+			self.records.append(record)
+
+		self.patients = np.array(patients, dtype=np.int32)
+		self.tests = np.array(tests, dtype=np.int32)
+		self.units = np.array(units, dtype=np.int32)
+		self.statuses = np.array(statuses, dtype=np.int32)
+		self.texts = np.array(texts, dtype=np.int32)
+		self.values = np.array(values, dtype=np.float64)
+		self.test_dates = np.array(test_dates, dtype='datetime64[s]')
+		self.result_dates = np.array(result_dates, dtype='datetime64[s]')
+
+	@classmethod
+	def from_columns(cls, names, columns):
+		# names maps each of STRING_COLUMNS to its list of strings; columns maps every column to an array
+		table = cls()
+		table.patient_codes, table.test_codes, table.unit_codes, table.status_codes, table.text_codes = (
+			{name: code for code, name in enumerate(names[column])} for column in cls.STRING_COLUMNS)
+		for column, values in columns.items():
+			setattr(table, column, values)
+		table.records = None
+		return table
+
+	def names(self, column):
+		return list({'patients': self.patient_codes, 'tests': self.test_codes, 'units': self.unit_codes,
+		             'statuses': self.status_codes, 'texts': self.text_codes}[column])
+
+	def __len__(self):
+		return len(self.values)
+
+	def mask(self, patient_id=None, test_name=None, abnormal_only=False, start_date=None, end_date=None,
+	         status=None, tests=None):
+		mask = np.ones(len(self), dtype=bool)
+		if patient_id:
+			mask &= self.patients == self.patient_codes.get(patient_id, -1)
+		if test_name:
+			mask &= self.tests == self.test_codes.get(test_name, -1)
+		if status:
+			codes = [code for name, code in self.status_codes.items() if name.lower() == status.lower()]
+			mask &= np.isin(self.statuses, codes)
+		if start_date:
+			mask &= self.test_dates >= np.datetime64(start_date, 's')
+		if end_date:
+			mask &= self.test_dates <= np.datetime64(end_date, 's')
+		if abnormal_only:
+			mask &= self.abnormal(tests or {})
+		return mask
+
+	def abnormal(self, tests):
+		# Per-category bounds looked up by test code; NaN bounds never compare true
+		lower = np.full(len(self.test_codes), np.nan)
+		upper = np.full(len(self.test_codes), np.nan)
+		for name, code in self.test_codes.items():
+			definition = tests.get(name)
+			if definition and definition.bounds:
+				if definition.bounds.lower is not None:
+					lower[code] = definition.bounds.lower
+				if definition.bounds.upper is not None:
+					upper[code] = definition.bounds.upper
+		return (self.values <= lower[self.tests]) | (self.values >= upper[self.tests])
+
+	def select(self, mask):
+		positions = np.flatnonzero(mask)
+		if self.records is not None:
+			return [self.records[position] for position in positions]
+		patients, tests, units, statuses, texts = (self.names(column) for column in self.STRING_COLUMNS)
+		return [PatientRecord(patients[self.patients[position]], tests[self.tests[position]],
+		                      self.test_dates[position].item(), float(self.values[position]),
+		                      units[self.units[position]], statuses[self.statuses[position]],
+		                      self.result_dates[position].item(), texts[self.texts[position]])
+		        for position in positions]
+
+	def summary(self, mask=None):
+		# Same statistics as generate_summary, which only counts records that have a result date
+		completed = ~np.isnat(self.result_dates)
+		if mask is not None:
+			completed &= mask
+		if not completed.any():
+			return {'min_val': None, 'max_val': None, 'avg_val': None, 'min_ta': None, 'max_ta': None, 'avg_ta': None}
+
+		values = self.values[completed]
+		turnaround = (self.result_dates[completed] - self.test_dates[completed]).astype(np.int64)
+		return {
+			'min_val': float(values.min()),
+			'max_val': float(values.max()),
+			'avg_val': float(values.mean()),
+			'min_ta': datetime.timedelta(seconds=int(turnaround.min())),
+			'max_ta': datetime.timedelta(seconds=int(turnaround.max())),
+			'avg_ta': datetime.timedelta(seconds=float(turnaround.mean()))
+		}
+
+
+class RecordSnapshot:
+	# Binary image of the test catalogue and a RecordTable, stamped with the signatures of the text sources
+	# it was built from. Layout: magic, a little-endian uint32 header length, a JSON header (source stamp,
+	# catalogue, and the offset of every block), then 8-byte aligned blocks: int32 string codes, float64
+	# results, int64 epoch-second dates (NaT for no result date) and one newline-joined UTF-8 block per
+	# string table. Loading maps the file and wraps the blocks with numpy.frombuffer; nothing is parsed per row
+	MAGIC = b'MRSNAP02'
+	COLUMNS = (('patients', '<i4'), ('tests', '<i4'), ('units', '<i4'), ('statuses', '<i4'), ('texts', '<i4'),
+	           ('values', '<f8'), ('test_dates', '<i8'), ('result_dates', '<i8'))
+	DATE_COLUMNS = ('test_dates', 'result_dates')
+
+	def __init__(self, path):
+		self.path = path
+
+	def save(self, source, tests, table):
+		blocks = []
+		offset = 0
+		header = {'source': source, 'rows': len(table), 'tests': [definition.to_line() for definition in tests.values()],
+		          'columns': {}, 'strings': {}}
+		for column, dtype in self.COLUMNS:
+			data = getattr(table, column)
+			if column in self.DATE_COLUMNS:
+				data = data.view(np.int64)
+			data = np.ascontiguousarray(data, dtype=dtype).tobytes()
+			header['columns'][column] = offset
+			blocks.append(data)
+			offset += len(data)
+			offset += self.pad(blocks, offset)
+		for column in table.STRING_COLUMNS:
+			data = "\n".join(table.names(column)).encode()
+			header['strings'][column] = [offset, len(data)]
+			blocks.append(data)
+			offset += len(data)
+			offset += self.pad(blocks, offset)
+		encoded = json.dumps(header).encode()
+		prefix = self.MAGIC + len(encoded).to_bytes(4, 'little') + encoded
+		atomic_write(self.path, [prefix, b'\0' * (-len(prefix) % 8)] + blocks, binary=True)
+
+	@staticmethod
+	def pad(blocks, offset):
+		padding = -offset % 8
+		if padding:
+			blocks.append(b'\0' * padding)
+		return padding
+
+	def load(self, source):
+		# (tests, table) from the snapshot, or None if it is missing, unreadable or built from other sources
+		try:
+			with open(self.path, 'rb') as file:
+				mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		except (FileNotFoundError, ValueError, OSError):
+			return None
+		try:
+			if mapped[:8] != self.MAGIC:
+				return None
+			length = int.from_bytes(mapped[8:12], 'little')
+			header = json.loads(mapped[12:12 + length].decode())
+		except ValueError:
+			return None
+		if header['source'] != source:
+			return None
+		base = 12 + length + (-(12 + length) % 8)
+		rows = header['rows']
+		columns = {}
+		for column, dtype in self.COLUMNS:
+			data = np.frombuffer(mapped, dtype=dtype, count=rows, offset=base + header['columns'][column])
+			columns[column] = data.view('datetime64[s]') if column in self.DATE_COLUMNS else data
+		names = {}
+		for column, (offset, size) in header['strings'].items():
+			text = mapped[base + offset:base + offset + size].decode()
+			names[column] = text.split("\n") if text else []
+		tests = {}
+		for line in header['tests']:
+			name, range_str, unit, turnaround_time = line.split(';')
+			tests[name] = TestDefinition(name, range_str, unit, turnaround_time)
+		return tests, RecordTable.from_columns(names, columns)
+
+
+def record_matches(record, tests, patient_id=None, test_name=None, abnormal_only=False, start_date=None,
+                   end_date=None, status=None):
+	if patient_id and record.patient_id != patient_id:
+		return False
+	if test_name and record.test_name != test_name:
+		return False
+	if status and record.status.lower() != status.lower():
+		return False
+	if start_date and record.test_date < start_date:
+		return False
+	if end_date and record.test_date > end_date:
+		return False
+
+	if abnormal_only:
+		definition = tests.get(record.test_name)
+		return bool(definition and definition.bounds and definition.bounds.is_abnormal(record.result))
+	return True
+
+
+def whole_days(start_date=None, end_date=None):
+	# Whether an inclusive test-date range covers whole days: from midnight to the day's last second
+	return (start_date is None or start_date.time() == datetime.time.min) and \
+		(end_date is None or end_date.time() >= datetime.time(23, 59, 59))
+
+
+def chunk_lines(path, start, end, patient_id=None, test_name=None):
+	# The non-empty lines starting inside [start, end); with a patient or test, only those passing the
+	# byte-level prefilter of read_record_lines
+	with open(path, 'rb') as file:
+		if patient_id or test_name:
+			with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+				yield from matching_lines(mapped, patient_id, test_name, start, end)
+			return
+		if start:
+			file.seek(start - 1)
+			file.readline()
+		position = file.tell()
+		while position < end:
+			raw = file.readline()
+			if not raw:
+				break
+			position += len(raw)
+			line = raw.decode().strip()
+			if line:
+				yield line
+
+
+def scan_chunk(path, start, end, tests, summarize, criteria):
+	# Worker for the parallel scan: handles every line that starts inside [start, end). summarize is the
+	# accumulator class to fold matches into, or None to return the matching records
+	summary = summarize() if summarize else None
+	results = []
+	for line in chunk_lines(path, start, end, *criteria[:2]):
+		record = PatientRecord.parse(line)
+		if record_matches(record, tests, *criteria):
+			if summary is not None:
+				summary.add(record)
+			else:
+				results.append(record)
+	return summary if summarize else results
+
+
+class SummaryAccumulator:
+	# Running min/max/sum of test values and turnaround times; partial accumulators can be merged
+	def __init__(self):
+		self.value_count = 0
+		self.value_sum = 0.0
+		self.min_val = self.max_val = None
+		self.ta_count = 0
+		self.ta_sum = datetime.timedelta()
+		self.min_ta = self.max_ta = None
+
+	def add(self, record):
+		if isinstance(record, PatientRecord):
+			if record.result_date is None:
+				print(f"Skipping record due to insufficient fields: {record}")
+				return
+			self.add_completed(record)
+			return
+
+		fields = record.strip().split(', ')
+
+		if len(fields) < 6:
+			print(f"Skipping record due to insufficient fields: {record}")
+			return
+
+		# Extract and validate test value
+		try:
+			test_value = float(fields[2].strip())
+		except ValueError:
+			print(f"Invalid test value: {fields[2]}")
+			return
+		self.add_value(test_value)
+
+		# Extract and convert turnaround time
+		try:
+			turnaround_time = parse_timestamp(fields[5].strip()) - parse_timestamp(fields[1].strip())
+		except ValueError:
+			print(f"Invalid date format: {fields[1]} or {fields[5]}")
+			return
+		self.add_turnaround(turnaround_time)
+
+	def add_completed(self, record):
+		# Folds in a PatientRecord's value and turnaround; one without a result date is left out quietly
+		if record.result_date is not None:
+			self.add_value(record.result)
+			self.add_turnaround(record.result_date - record.test_date)
+
+	def add_value(self, value):
+		self.value_count += 1
+		self.value_sum += value
+		if self.min_val is None or value < self.min_val:
+			self.min_val = value
+		if self.max_val is None or value > self.max_val:
+			self.max_val = value
+
+	def add_turnaround(self, turnaround_time):
+		self.ta_count += 1
+		self.ta_sum += turnaround_time
+		if self.min_ta is None or turnaround_time < self.min_ta:
+			self.min_ta = turnaround_time
+		if self.max_ta is None or turnaround_time > self.max_ta:
+			self.max_ta = turnaround_time
+
+	def merge(self, other):
+		self.value_count += other.value_count
+		self.value_sum += other.value_sum
+		self.ta_count += other.ta_count
+		self.ta_sum += other.ta_sum
+		for name, pick in (('min_val', min), ('max_val', max), ('min_ta', min), ('max_ta', max)):
+			mine, theirs = getattr(self, name), getattr(other, name)
+			if theirs is not None:
+				setattr(self, name, theirs if mine is None else pick(mine, theirs))
+		return self
+
+	def result(self):
+		return {
+			'min_val': self.min_val,
+			'max_val': self.max_val,
+			'avg_val': self.value_sum / self.value_count if self.value_count else None,
+			'min_ta': self.min_ta,
+			'max_ta': self.max_ta,
+			'avg_ta': self.ta_sum / self.ta_count if self.ta_count else None
+		}
+
+
+class RetractableSummary(SummaryAccumulator):
+	# A SummaryAccumulator that can also take records back out; value counts let min/max
+	# be recovered when the current extreme is removed. The counters hold an entry per distinct result and
+	# turnaround, so their size follows the number of distinct values in the group, not a constant
+	def __init__(self):
+		super().__init__()
+		self.values = collections.Counter()
+		self.turnarounds = collections.Counter()
+
+	def add_value(self, value):
+		super().add_value(value)
+		self.values[value] += 1
+
+	def add_turnaround(self, turnaround_time):
+		super().add_turnaround(turnaround_time)
+		self.turnarounds[turnaround_time] += 1
+
+	def remove(self, record):
+		self.value_count -= 1
+		self.value_sum -= record.result
+		self.min_val, self.max_val = self._discard(self.values, record.result, self.min_val, self.max_val)
+		turnaround_time = record.result_date - record.test_date
+		self.ta_count -= 1
+		self.ta_sum -= turnaround_time
+		self.min_ta, self.max_ta = self._discard(self.turnarounds, turnaround_time, self.min_ta, self.max_ta)
+
+	@staticmethod
+	def _discard(counter, value, low, high):
+		counter[value] -= 1
+		if counter[value] <= 0:
+			del counter[value]
+			if not counter:
+				return None, None
+			if value == low:
+				low = min(counter)
+			if value == high:
+				high = max(counter)
+		return low, high
+
+
+class QuantileSketch:
+	# Mergeable log-bucketed sketch (DDSketch-style): a value lands in bucket ceil(log_gamma(|x|)), so any
+	# quantile is within relative_accuracy of the true one while memory is capped at max_buckets per sign
+	# (beyond that the buckets nearest zero are folded together). Count, mean and variance are exact
+	def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+		self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+		self.log_gamma = math.log(self.gamma)
+		self.max_buckets = max_buckets
+		self.positive = collections.Counter()
+		self.negative = collections.Counter()
+		self.zero = 0
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.min = self.max = None
+
+	def add(self, value):
+		if value > 1e-9:
+			self.positive[math.ceil(math.log(value) / self.log_gamma)] += 1
+			self.collapse(self.positive)
+		elif value < -1e-9:
+			self.negative[math.ceil(math.log(-value) / self.log_gamma)] += 1
+			self.collapse(self.negative)
+		else:
+			self.zero += 1
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (value - self.mean)
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def collapse(self, buckets):
+		while len(buckets) > self.max_buckets:
+			lowest = sorted(buckets)[:2]
+			buckets[lowest[1]] += buckets.pop(lowest[0])
+
+	def merge(self, other):
+		if not other.count:
+			return self
+		self.positive.update(other.positive)
+		self.negative.update(other.negative)
+		self.collapse(self.positive)
+		self.collapse(self.negative)
+		self.zero += other.zero
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		self.mean += delta * other.count / count
+		self.m2 += other.m2 + delta * delta * self.count * other.count / count
+		self.count = count
+		self.min = other.min if self.min is None else min(self.min, other.min)
+		self.max = other.max if self.max is None else max(self.max, other.max)
+		return self
+
+	def buckets(self):
+		# (representative value, count) pairs in ascending value order
+		for index in sorted(self.negative, reverse=True):
+			yield -2 * self.gamma ** index / (self.gamma + 1), self.negative[index]
+		if self.zero:
+			yield 0.0, self.zero
+		for index in sorted(self.positive):
+			yield 2 * self.gamma ** index / (self.gamma + 1), self.positive[index]
+
+	def quantile(self, fraction):
+		if not self.count:
+			return None
+		rank = fraction * (self.count - 1)
+		seen = 0
+		for value, count in self.buckets():
+			seen += count
+			if seen > rank:
+				return min(max(value, self.min), self.max)
+		return self.max
+
+	def std(self):
+		return math.sqrt(self.m2 / self.count) if self.count else None
+
+	def histogram(self, bins=10):
+		# Equal-width bins over [min, max] as (low, high, count), filled from the bucket representatives
+		if not self.count:
+			return []
+		width = (self.max - self.min) / bins or 1
+		counts = [0] * bins
+		for value, count in self.buckets():
+			counts[min(max(int((value - self.min) / width), 0), bins - 1)] += count
+		return [(self.min + width * position, self.min + width * (position + 1), count)
+		        for position, count in enumerate(counts)]
+
+
+class SketchSummary(SummaryAccumulator):
+	# A SummaryAccumulator that also sketches values and turnaround seconds for median, p90, p99,
+	# standard deviation and histograms
+	def __init__(self):
+		super().__init__()
+		self.values = QuantileSketch()
+		self.turnarounds = QuantileSketch()
+
+	def add_value(self, value):
+		super().add_value(value)
+		self.values.add(value)
+
+	def add_turnaround(self, turnaround_time):
+		super().add_turnaround(turnaround_time)
+		self.turnarounds.add(turnaround_time.total_seconds())
+
+	def merge(self, other):
+		super().merge(other)
+		self.values.merge(other.values)
+		self.turnarounds.merge(other.turnarounds)
+		return self
+
+	def result(self, bins=10):
+		summary = super().result()
+		seconds = lambda value: datetime.timedelta(seconds=value) if value is not None else None
+		for name, fraction in (('median', 0.5), ('p90', 0.9), ('p99', 0.99)):
+			summary[f'{name}_val'] = self.values.quantile(fraction)
+			summary[f'{name}_ta'] = seconds(self.turnarounds.quantile(fraction))
+		summary['std_val'] = self.values.std()
+		summary['std_ta'] = seconds(self.turnarounds.std())
+		summary['histogram_val'] = self.values.histogram(bins)
+		summary['histogram_ta'] = [(seconds(low), seconds(high), count)
+		                           for low, high, count in self.turnarounds.histogram(bins)]
+		return summary
+
+
+class DistributionSummary:
+	# One SketchSummary per test name; mergeable like SummaryAccumulator, so the parallel scan can use it
+	def __init__(self):
+		self.tests = {}
+
+	def add(self, record):
+		if not isinstance(record, PatientRecord):
+			record = PatientRecord.parse(record.strip())
+		if record.test_name not in self.tests:
+			self.tests[record.test_name] = SketchSummary()
+		self.tests[record.test_name].add_completed(record)
+
+	def merge(self, other):
+		for test_name, summary in other.tests.items():
+			if test_name in self.tests:
+				self.tests[test_name].merge(summary)
+			else:
+				self.tests[test_name] = summary
+		return self
+
+	def result(self, bins=10):
+		return {test_name: summary.result(bins) for test_name, summary in sorted(self.tests.items())}
+
+
+GROUP_BY = ('test_name', 'patient_id', 'status', 'day', 'month')
+
+
+def group_key(record, group_by):
+	if group_by == 'test_name':
+		return record.test_name
+	if group_by == 'patient_id':
+		return record.patient_id
+	if group_by == 'status':
+		return record.status.lower()
+	if group_by == 'day':
+		return record.test_date.strftime('%Y-%m-%d')
+	return record.test_date.strftime('%Y-%m')
+
+
+class GroupedSummary:
+	# One SummaryAccumulator and record count per group key, filled in a single pass over the records; every
+	# record is counted, but only those with a result date feed the statistics. Partial results merge like
+	# SummaryAccumulator, so the parallel scan can build them in its workers
+	def __init__(self, group_by):
+		if group_by not in GROUP_BY:
+			raise ValueError(f"Cannot group by {group_by}; choose one of {', '.join(GROUP_BY)}")
+		self.group_by = group_by
+		self.groups = {}
+		self.counts = collections.Counter()
+
+	def add(self, record):
+		if not isinstance(record, PatientRecord):
+			record = PatientRecord.parse(record.strip())
+		key = group_key(record, self.group_by)
+		if key not in self.groups:
+			self.groups[key] = SummaryAccumulator()
+		self.groups[key].add_completed(record)
+		self.counts[key] += 1
+
+	def merge(self, other):
+		for key, summary in other.groups.items():
+			if key in self.groups:
+				self.groups[key].merge(summary)
+			else:
+				self.groups[key] = summary
+		self.counts.update(other.counts)
+		return self
+
+	def result(self):
+		# Rows sorted by group, each the generate_summary statistics plus the group and its record count
+		rows = []
+		for key, summary in sorted(self.groups.items()):
+			row = {self.group_by: key, 'count': self.counts[key]}
+			row.update(summary.result())
+			rows.append(row)
+		return rows
+
+
+class RunningAggregates:
+	# Summary statistics per test name, per patient and per test-date day, kept up to date
+	# on every write so summaries don't need to scan the records. Each record is counted in all three
+	# groupings, each keeping its own RetractableSummary value counts, so memory grows with the records
+	# (up to three counter entries each for distinct results and turnarounds), not just with the groups.
+	# counts holds the number of records per group, those without a result date included
+	GROUPINGS = ('test_name', 'patient_id', 'day')
+
+	def __init__(self, records=()):
+		self.groups = {grouping: {} for grouping in self.GROUPINGS}
+		self.counts = {grouping: collections.Counter() for grouping in self.GROUPINGS}
+		for record in records:
+			self.add(record)
+
+	@staticmethod
+	def keys(record):
+		return zip(RunningAggregates.GROUPINGS, (record.test_name, record.patient_id, record.test_date.date()))
+
+	def add(self, record):
+		# Like generate_summary, only records with a result date contribute to the statistics
+		for grouping, key in self.keys(record):
+			self.counts[grouping][key] += 1
+		if record.result_date is None:
+			return
+		for grouping, key in self.keys(record):
+			self.groups[grouping].setdefault(key, RetractableSummary()).add(record)
+
+	def remove(self, record):
+		for grouping, key in self.keys(record):
+			self.counts[grouping][key] -= 1
+			if self.counts[grouping][key] <= 0:
+				del self.counts[grouping][key]
+		if record.result_date is None:
+			return
+		for grouping, key in self.keys(record):
+			group = self.groups[grouping].get(key)
+			if group is None:
+				continue
+			group.remove(record)
+			if not group.value_count:
+				del self.groups[grouping][key]
+
+	def summary(self, grouping, key):
+		group = self.groups[grouping].get(key)
+		return (group or SummaryAccumulator()).result()
+
+	def summary_for_days(self, first_day=None, last_day=None):
+		summary = SummaryAccumulator()
+		for day, group in self.groups['day'].items():
+			if (first_day is None or first_day <= day) and (last_day is None or day <= last_day):
+				summary.merge(group)
+		return summary.result()
+
+	def total(self):
+		summary = SummaryAccumulator()
+		for group in self.groups['test_name'].values():
+			summary.merge(group)
+		return summary.result()
+
+
+class LatencyHistogram:
+	# Call count and latency in power-of-two buckets from 1us to ~16s; percentiles are bucket upper bounds
+	BOUNDS = tuple(2 ** n / 1e6 for n in range(25))
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+	def add(self, seconds):
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+		self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+
+	def percentile(self, fraction):
+		if not self.count:
+			return None
+		rank = fraction * self.count
+		seen = 0
+		for index, count in enumerate(self.buckets):
+			seen += count
+			if seen >= rank:
+				return self.BOUNDS[index] if index < len(self.BOUNDS) else self.max
+		return self.max
+
+	def result(self):
+		return {
+			'calls': self.count,
+			'total': self.total,
+			'avg': self.total / self.count if self.count else None,
+			'max': self.max,
+			'p50': self.percentile(0.5),
+			'p90': self.percentile(0.9),
+			'p99': self.percentile(0.99),
+			'buckets': {f"<={bound * 1e6:.0f}us": count for bound, count in zip(self.BOUNDS, self.buckets) if count}
+		}
+
+
+class Instrumentation:
+	# Opt-in timing of MedicalRecordSystem operations and the module validators. Lines and bytes are
+	# counted as they come out of the record storage (journal included) and charged to the outermost
+	# operation running on that thread; in-memory, columnar and SQL-pushed-down queries read none
+	METHODS = ('load_tests', 'add_test', 'remove_test', 'replace_test', 'add_patient_record', 'add_patient_records',
+	           'import_csv', 'export_csv', 'import_text', 'export_text', 'update_patient_record', 'delete_patient_record',
+	           'compact', 'patient_timeline', 'filter_tests', 'summarize', 'generate_summary', 'record_exists')
+	VALIDATORS = ('is_valid_date', 'is_valid_range', 'is_valid_unit')
+	# The module validators are wrapped once, while at least one instrumentation is open, and time into
+	# every open one
+	hooked = []
+	hooks_lock = threading.Lock()
+	validator_originals = {}
+
+	def __init__(self, system, log_interval=0, slow_query=None, log=print):
+		self.system = system
+		self.log = log
+		self.slow_query = slow_query
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.histograms = collections.defaultdict(LatencyHistogram)
+		self.lines = collections.Counter()
+		self.bytes = collections.Counter()
+		self.capture_target = None
+		self.capture_memory = False
+		self.last_capture = None
+		self.stop = threading.Event()
+		for name in self.METHODS:
+			setattr(system, name, self.wrap(name, getattr(system, name)))
+		read_lines = system._read_lines
+		system._read_lines = lambda *args, **kwargs: self.count_lines(read_lines(*args, **kwargs))
+		self.hook_validators()
+		if log_interval:
+			thread = threading.Thread(target=self.log_periodically, args=(log_interval,), daemon=True)
+			thread.start()
+
+	def close(self):
+		# Stops the periodic log and the validator timing; the last one open puts the module validators back
+		self.stop.set()
+		module = sys.modules[__name__]
+		with Instrumentation.hooks_lock:
+			if self not in Instrumentation.hooked:
+				return
+			Instrumentation.hooked.remove(self)
+			if not Instrumentation.hooked:
+				for name, function in Instrumentation.validator_originals.items():
+					setattr(module, name, function)
+				Instrumentation.validator_originals.clear()
+
+	def hook_validators(self):
+		module = sys.modules[__name__]
+		with Instrumentation.hooks_lock:
+			if not Instrumentation.hooked:
+				for name in self.VALIDATORS:
+					function = getattr(module, name)
+					Instrumentation.validator_originals[name] = function
+					setattr(module, name, self.time_validator(name, function))
+			Instrumentation.hooked.append(self)
+
+	@staticmethod
+	def time_validator(name, function):
+		def timed(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				elapsed = time.perf_counter() - start
+				for instrumentation in list(Instrumentation.hooked):
+					instrumentation.record(name, elapsed)
+		return timed
+
+	def record(self, name, elapsed):
+		with self.lock:
+			self.histograms[name].add(elapsed)
+
+	def wrap(self, name, function):
+		def timed(*args, **kwargs):
+			outer = getattr(self.local, 'operation', None) is None
+			if outer:
+				self.local.operation = name
+			capture = outer and self.capture_target in (name, '*')
+			try:
+				if capture:
+					return self.run_captured(name, function, args, kwargs)
+				start = time.perf_counter()
+				try:
+					return function(*args, **kwargs)
+				finally:
+					elapsed = time.perf_counter() - start
+					with self.lock:
+						self.histograms[name].add(elapsed)
+					if outer and self.slow_query is not None and elapsed >= self.slow_query:
+						self.log(f"Slow {name}: {elapsed * 1000:.1f} ms, args={args}, kwargs={kwargs}")
+			finally:
+				if outer:
+					self.local.operation = None
+		return timed
+
+	def count_lines(self, lines):
+		operation = getattr(self.local, 'operation', None) or '-'
+		count = size = 0
+		try:
+			for line in lines:
+				count += 1
+				size += len(line) + 1
+				yield line
+		finally:
+			with self.lock:
+				self.lines[operation] += count
+				self.bytes[operation] += size
+
+	def capture(self, name='*', memory=False):
+		# Profiles the next top-level call of the named operation (any operation for '*') with cProfile,
+		# and tracemalloc when memory is set; the report lands in last_capture
+		self.capture_target = name
+		self.capture_memory = memory
+
+	def run_captured(self, name, function, args, kwargs):
+		self.capture_target = None
+		profile = cProfile.Profile()
+		if self.capture_memory:
+			tracemalloc.start()
+		start = time.perf_counter()
+		try:
+			return profile.runcall(function, *args, **kwargs)
+		finally:
+			elapsed = time.perf_counter() - start
+			report = {'operation': name, 'seconds': elapsed}
+			if self.capture_memory:
+				snapshot = tracemalloc.take_snapshot()
+				report['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+				tracemalloc.stop()
+				report['allocations'] = [str(stat) for stat in snapshot.statistics('lineno')[:15]]
+			text = io.StringIO()
+			pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(25)
+			report['profile'] = text.getvalue()
+			with self.lock:
+				self.histograms[name].add(elapsed)
+			self.last_capture = report
+
+	def stats(self):
+		with self.lock:
+			operations = {}
+			for name, histogram in self.histograms.items():
+				operations[name] = histogram.result()
+				if name in self.lines:
+					operations[name]['lines_scanned'] = self.lines[name]
+					operations[name]['bytes_read'] = self.bytes[name]
+			return {
+				'operations': operations,
+				'lines_scanned': sum(self.lines.values()),
+				'bytes_read': sum(self.bytes.values())
+			}
+
+	def log_line(self):
+		stats = self.stats()
+		parts = []
+		for name, result in sorted(stats['operations'].items(), key=lambda item: -item[1]['total']):
+			parts.append(f"{name} {result['calls']}x avg {result['avg'] * 1000:.2f}ms p99 {result['p99'] * 1000:.2f}ms")
+		return f"[stats] lines {stats['lines_scanned']} bytes {stats['bytes_read']}; " + "; ".join(parts)
+
+	def log_periodically(self, interval):
+		while not self.stop.wait(interval):
+			self.log(self.log_line())
+
+
+class RecordValidator:
+	# Validates candidate record rows a column at a time against the test names and units of the catalogue
+	# it was built from. Each row gets an error code (OK when valid); the first failing check, in column
+	# order, wins, and message() turns a code back into the text validate_record reports
+	OK = 0
+	BAD_COLUMNS = 1
+	BAD_PATIENT_ID = 2
+	UNKNOWN_TEST = 3
+	BAD_TEST_DATE = 4
+	BAD_RESULT = 5
+	BAD_UNIT = 6
+	BAD_STATUS = 7
+	BAD_RESULT_DATE = 8
+	RESULT_BEFORE_TEST = 9
+	MESSAGES = {
+		BAD_COLUMNS: "expected 6 or 7 columns",
+		BAD_PATIENT_ID: "invalid patient ID",
+		UNKNOWN_TEST: "test {test_name} does not exist",
+		BAD_TEST_DATE: "invalid test date",
+		BAD_RESULT: "invalid result",
+		BAD_UNIT: "invalid unit",
+		BAD_STATUS: "invalid status",
+		BAD_RESULT_DATE: "invalid result date",
+		RESULT_BEFORE_TEST: "result date must be after the test date"
+	}
+
+	def __init__(self, tests):
+		self.test_names = frozenset(tests)
+		self.units = frozenset(definition.unit for definition in tests.values())
+
+	@staticmethod
+	def parse_date(date_str):
+		try:
+			return parse_timestamp(date_str)
+		except ValueError:
+			return None
+
+	def validate_columns(self, patient_ids, test_names, test_dates, results, units, statuses, result_dates=None):
+		# Equal-length columns of stripped strings; an empty or None result date means the row has none
+		errors = [self.OK] * len(patient_ids)
+		checks = (
+			(self.BAD_PATIENT_ID, patient_ids, lambda value: len(value) == 7 and value.isdigit()),
+			(self.UNKNOWN_TEST, test_names, self.test_names.__contains__),
+			(self.BAD_TEST_DATE, test_dates, self.parse_date),
+			(self.BAD_RESULT, results, RESULT_PATTERN.fullmatch),
+			(self.BAD_UNIT, units, self.units.__contains__),
+			(self.BAD_STATUS, statuses, lambda value: value.lower() in VALID_STATUSES)
+		)
+		for code, column, valid in checks:
+			for position, value in enumerate(column):
+				if not errors[position] and not valid(value):
+					errors[position] = code
+		if result_dates is not None:
+			for position, result_date in enumerate(result_dates):
+				if errors[position] or not result_date:
+					continue
+				parsed = self.parse_date(result_date)
+				if parsed is None:
+					errors[position] = self.BAD_RESULT_DATE
+				elif parsed <= parse_timestamp(test_dates[position]):
+					errors[position] = self.RESULT_BEFORE_TEST
+		return errors
+
+	def validate_rows(self, rows):
+		# Rows of [patient_id, test_name, test_date, result, unit, status[, result_date]] are normalised in
+		# place (fields stripped, an empty result date dropped) and validated as columns
+		errors = [self.OK] * len(rows)
+		shaped = []
+		for position, row in enumerate(rows):
+			row[:] = [field.strip() for field in row]
+			if len(row) == 7 and not row[6]:
+				row.pop()
+			if len(row) in (6, 7):
+				shaped.append(position)
+			else:
+				errors[position] = self.BAD_COLUMNS
+		if shaped:
+			columns = [[rows[position][column] for position in shaped] for column in range(6)]
+			result_dates = [rows[position][6] if len(rows[position]) == 7 else None for position in shaped]
+			for position, error in zip(shaped, self.validate_columns(*columns, result_dates)):
+				errors[position] = error
+		return errors
+
+	def message(self, code, row=()):
+		if not code:
+			return None
+		return self.MESSAGES[code].format(test_name=row[1] if len(row) > 1 else '')
 
 
 class MedicalRecordSystem:
-	def __init__(self, test_file='medicalTest.txt', record_file='medicalRecord.txt'):
+	def __init__(self, test_file='medicalTest.txt', record_file='medicalRecord.txt', in_memory=False,
+	             journal=False, columnar=False, partitioned=False, database=None, workers=0, cache_size=0,
+	             cache_bytes=64 << 20, aggregates=False, group_commit=False, instrument=False, stats_interval=0,
+	             slow_query=None, indexed=False, snapshot=False):
 		self.test_file = test_file
 		self.record_file = record_file
-		self.tests = self.load_tests()
+		self.test_lock = FileLock(test_file)
+		if database:
+			self.storage = SQLiteRecordStorage(database)
+		elif partitioned:
+			self.storage = PartitionedRecordFile(record_file, indexed)
+		else:
+			self.storage = RecordFile(record_file, indexed)
+		self.journal = RecordJournal(self.storage) if journal else None
+		self.tests = None
+		self.table = None
+		self.table_signature = None
+		self.snapshot = None
+		if snapshot:
+			# The snapshot feeds the columnar table, so it implies columnar queries
+			self.snapshot = RecordSnapshot(record_file + '.snapshot')
+			columnar = True
+			self.table_signature = self._signature()
+			loaded = self.snapshot.load(self._snapshot_source())
+			if loaded is not None:
+				self.tests, self.table = loaded
+		if self.tests is None:
+			self.tests = self.load_tests()
+		self.validator = None
+		self.writer = None
+		if group_commit:
+			# Appends are fsynced, with concurrent callers sharing one write and fsync per batch
+			self.storage.sync = True
+			self.writer = GroupCommitWriter(self._write_lines)
+		self.store = None
+		self.store_signature = None
+		if in_memory:
+			self.store_signature = self._signature()
+			self.store = RecordStore.load(self._read_lines())
+		self.columnar = columnar
+		self.workers = workers
+		self.cache = PatientTimelineCache(cache_size, cache_bytes) if cache_size else None
+		# Running aggregates are built by the first summary that can use them
+		self.use_aggregates = aggregates
+		self.aggregates = None
+		self.aggregates_signature = None
+		self.listeners = []
+		self.instrumentation = None
+		if instrument:
+			self.instrumentation = Instrumentation(self, stats_interval, slow_query)
+
+	def stats(self):
+		# Call counts, latency histograms and lines/bytes read per operation; None unless instrument=True
+		if self.instrumentation is None:
+			return None
+		return self.instrumentation.stats()
 
 	def load_tests(self):
 		tests = {}
-		with open(self.test_file, 'r') as file:
+		with self._open_tests() as file:
 			for line in file:
 				try:
 					name, range_str, unit, turnaround_time = line.strip().split(';')
-					tests[name] = {
-						'range': range_str,
-						'unit': unit,
-						'turnaround_time': turnaround_time
-					}
+					tests[name] = TestDefinition(name, range_str, unit, turnaround_time)
 				except ValueError as e:
 					print(f"Skipping line due to format issue: {line.strip()}")
 					print(f"Error: {e}")
 		return tests
 
 	def add_test(self, test_name, range_str, unit, turnaround_time):
-		self.tests[test_name] = {
-			'range': range_str,
-			'unit': unit,
-			'turnaround_time': turnaround_time
-		}
-		with open(self.test_file, 'a') as file:
-			file.write(f"{test_name};{range_str};{unit};{turnaround_time}\n")
+		self.tests[test_name] = TestDefinition(test_name, range_str, unit, turnaround_time)
+		self.validator = None
+		if isinstance(self.storage, SQLiteRecordStorage):
+			self.storage.save_test(test_name, range_str, unit, turnaround_time)
+		else:
+			with self.test_lock:
+				append_lines(self.test_file, [f"{test_name};{range_str};{unit};{turnaround_time}"])
+
+	def remove_test(self, test_name):
+		self.tests.pop(test_name, None)
+		self.validator = None
+		if isinstance(self.storage, SQLiteRecordStorage):
+			self.storage.remove_test(test_name)
+			return
+		with self.test_lock:
+			with open(self.test_file, 'r') as file:
+				lines = [line.rstrip('\r\n') for line in file]
+
+			kept = []
+			for line in lines:
+				if not line.startswith(f"{test_name};"):
+					kept.append(line)
+				else:
+					print(f"Deleted existing record for test: {test_name}")
+			atomic_write(self.test_file, kept)
+
+	def replace_test(self, test_name, range_str, unit, turnaround_time):
+		# Adds the test or replaces its definition in place with one locked rewrite, so the catalogue never
+		# goes without it
+		self.tests[test_name] = TestDefinition(test_name, range_str, unit, turnaround_time)
+		self.validator = None
+		if isinstance(self.storage, SQLiteRecordStorage):
+			self.storage.save_test(test_name, range_str, unit, turnaround_time)
+			return
+		line = f"{test_name};{range_str};{unit};{turnaround_time}"
+		with self.test_lock:
+			with open(self.test_file, 'r') as file:
+				lines = [existing.rstrip('\r\n') for existing in file]
+
+			kept = []
+			for existing in lines:
+				if not existing.startswith(f"{test_name};"):
+					kept.append(existing)
+				elif line is not None:
+					kept.append(line)
+					line = None
+			if line is not None:
+				kept.append(line)
+			atomic_write(self.test_file, kept)
+
+	def _open_tests(self):
+		if isinstance(self.storage, SQLiteRecordStorage):
+			return contextlib.closing(self.storage.read_test_lines())
+		return open(self.test_file, 'r')
 
 	def add_patient_record(self, patient_id, test_name, test_date, result, unit, status, result_date=None):
-		with open(self.record_file, 'a') as file:
-			if result_date:
-				file.write(f"{patient_id}: {test_name}, {test_date}, {result}, {unit}, {status}, {result_date}\n")
-			else:
-				file.write(f"{patient_id}: {test_name}, {test_date}, {result}, {unit}, {status}\n")
+		line = format_record_line(patient_id, test_name, test_date, result, unit, status, result_date)
+		store = self._current_store()
+		aggregates = self._fresh_aggregates()
+		if self.writer is not None:
+			self.writer.append(line)
+		else:
+			self._write_lines([line])
+		if store is not None:
+			store.add(PatientRecord.parse(line))
+		if aggregates is not None:
+			aggregates.add(PatientRecord.parse(line))
+		self._records_changed([patient_id])
+		self._notify([line])
+
+	def add_patient_records(self, lines):
+		# Batched form of add_patient_record for already formatted lines
+		store = self._current_store()
+		aggregates = self._fresh_aggregates()
+		if self.writer is not None:
+			self.writer.append_many(lines)
+		else:
+			self._write_lines(lines)
+		if store is not None:
+			for line in lines:
+				store.add(PatientRecord.parse(line))
+		if aggregates is not None:
+			for line in lines:
+				aggregates.add(PatientRecord.parse(line))
+		self._records_changed({record_key(line)[0] for line in lines})
+		self._notify(lines)
+
+	def add_listener(self, listener):
+		# listener(record, previous) is called with each PatientRecord once it is stored: previous is None for
+		# add_patient_record(s), and the record it replaced for update_patient_record
+		self.listeners.append(listener)
+
+	def _notify(self, lines, previous=None):
+		if self.listeners:
+			for line in lines:
+				record = PatientRecord.parse(line)
+				for listener in self.listeners:
+					listener(record, previous)
+
+	def _write_lines(self, lines):
+		if self.journal is not None:
+			self.journal.append_many(('A', line) for line in lines)
+		else:
+			self.storage.append_many(lines)
+
+	def import_csv(self, csv_file, batch_size=50000):
+		# Columns: patient_id, test_name, test_date, result, unit, status[, result_date]; an optional header row
+		# is skipped. Rows that fail validation or duplicate an existing patient/test pair are not written.
+		existing = self._record_keys()
+		validator = self.get_validator()
+		counts = {'imported': 0, 'duplicates': 0, 'invalid': 0}
+
+		with open(csv_file, 'r', newline='') as file:
+			rows = enumerate(csv.reader(file), start=1)
+			while True:
+				batch = list(itertools.islice(rows, batch_size))
+				if not batch:
+					break
+				if batch[0][0] == 1 and batch[0][1] and batch[0][1][0].strip().lower() == 'patient_id':
+					batch = batch[1:]
+				lines = []
+				errors = validator.validate_rows([row for row_number, row in batch])
+				for (row_number, row), error in zip(batch, errors):
+					if error:
+						print(f"Skipping row {row_number}: {validator.message(error, row)}")
+						counts['invalid'] += 1
+						continue
+					key = (row[0], row[1])
+					if key in existing:
+						counts['duplicates'] += 1
+						continue
+					existing.add(key)
+					lines.append(format_record_line(*row))
+				if lines:
+					self.add_patient_records(lines)
+					counts['imported'] += len(lines)
+		return counts
+
+	def import_text(self, record_file=None, test_file=None, batch_size=50000):
+		# Loads medicalTest.txt/medicalRecord.txt style files into this system's storage (e.g. a new
+		# database): a test replaces the one of the same name, and a record whose patient/test pair is
+		# already stored is skipped, so importing the same files again changes nothing
+		counts = {'tests': 0, 'imported': 0, 'duplicates': 0, 'invalid': 0}
+		if test_file:
+			with open(test_file, 'r') as file:
+				for line in file:
+					fields = line.strip().split(';')
+					if len(fields) != 4:
+						if line.strip():
+							print(f"Skipping line due to format issue: {line.strip()}")
+						continue
+					current = self.tests.get(fields[0])
+					if current is not None and current.to_line() == ';'.join(fields):
+						continue
+					self.replace_test(*fields)
+					counts['tests'] += 1
+		if record_file:
+			existing = self._record_keys()
+			lines = []
+			for line in RecordFile(record_file).read_lines():
+				try:
+					key = PatientRecord.parse(line).key
+				except (ValueError, IndexError):
+					print(f"Skipping malformed record: {line}")
+					counts['invalid'] += 1
+					continue
+				if key in existing:
+					counts['duplicates'] += 1
+					continue
+				existing.add(key)
+				lines.append(line)
+				if len(lines) >= batch_size:
+					self.add_patient_records(lines)
+					counts['imported'] += len(lines)
+					lines = []
+			if lines:
+				self.add_patient_records(lines)
+				counts['imported'] += len(lines)
+		return counts
+
+	def export_text(self, record_file=None, test_file=None):
+		# Writes the catalogue and the records out in the medicalTest.txt/medicalRecord.txt formats
+		if test_file:
+			with FileLock(test_file):
+				atomic_write(test_file, [definition.to_line() for definition in self.tests.values()])
+		if record_file:
+			RecordFile(record_file).rewrite(self._read_lines())
+
+	def _record_keys(self):
+		store = self._current_store()
+		if store is not None:
+			return set(store.by_key)
+		return {record_key(line) for line in self._read_lines()}
+
+	def validate_record(self, row):
+		# Checks one [patient_id, test_name, test_date, result, unit, status[, result_date]] row in place
+		# (fields are stripped, an empty result date dropped); returns an error message or None
+		validator = self.get_validator()
+		return validator.message(validator.validate_rows([row])[0], row)
+
+	def get_validator(self):
+		# Built from the catalogue on first use and dropped whenever a test is added or removed
+		if self.validator is None:
+			self.validator = RecordValidator(self.tests)
+		return self.validator
+
+	def export_csv(self, csv_file, **criteria):
+		# Streams the records matching the filter_tests criteria straight to CSV
+		with open(csv_file, 'w', newline='', buffering=1 << 20) as file:
+			writer = csv.writer(file)
+			writer.writerow(['patient_id', 'test_name', 'test_date', 'result', 'unit', 'status', 'result_date'])
+			count = 0
+			for record in self.iter_filter_tests(**criteria):
+				writer.writerow([record.patient_id, record.test_name, record.test_date.strftime('%Y-%m-%d %H:%M:%S'),
+				                 record.formatted_result, record.unit, record.status,
+				                 record.result_date.strftime('%Y-%m-%d %H:%M:%S') if record.result_date else ''])
+				count += 1
+		return count
 
 	def update_patient_record(self, patient_id, test_name, new_data):
-		records = []
-		updated = False
-		with open(self.record_file, 'r') as file:
-			for line in file:
-				if line.startswith(f"{patient_id}: {test_name},"):
-					line_parts = line.strip().split(', ')
-					line_parts[1] = f" {new_data['test_date']}"
-					line_parts[2] = f" {new_data['result']}"
-					line_parts[3] = f" {new_data['unit']}"
-					line_parts[4] = f" {new_data['status']}"
-					if 'result_date' in new_data:
-						line_parts.append(f" {new_data['result_date']}")
-					records.append(','.join(line_parts) + "\n")
-					updated = True
-				else:
-					records.append(line)
-
-		with open(self.record_file, 'w') as file:
-			file.writelines(records)
+		# new_data is either a PatientRecord or a dict of the raw field strings
+		if isinstance(new_data, PatientRecord):
+			new_line = PatientRecord(patient_id, test_name, new_data.test_date, new_data.result, new_data.unit,
+			                         new_data.status, new_data.result_date, new_data.result_text).to_line()
+		else:
+			new_line = format_record_line(patient_id, test_name, new_data['test_date'], new_data['result'],
+			                              new_data['unit'], new_data['status'], new_data.get('result_date'))
+		aggregates = self._fresh_aggregates()
+		old_records = self._key_records(patient_id, test_name) if aggregates is not None or self.listeners else []
+		if self.journal is not None:
+			updated = self.record_exists(patient_id, test_name)
+			if updated:
+				if self.store is not None:
+					self.store.replace(patient_id, test_name, new_line)
+				self.journal.append('U', patient_id, test_name, new_line)
+		else:
+			updated = self._rewrite_records(patient_id, test_name, new_line)
+		if updated and aggregates is not None:
+			for record in old_records:
+				aggregates.remove(record)
+				aggregates.add(PatientRecord.parse(new_line))
+		self._records_changed([patient_id])
+		if updated:
+			self._notify([new_line], old_records[-1] if old_records else None)
 
 		if not updated:
 			print(f"No record found for Patient ID: {patient_id} and Test Name: {test_name}.")
 
-	def filter_tests(self, patient_id=None, test_name=None, abnormal_only=False,
-	                 start_date=None, end_date=None, status=None):
-		results = []
-		with open(self.record_file, 'r') as file:
-			for line in file:
-				parts = line.strip().split(', ')
-				line_id = parts[0].split(':')[0]
-				line_test_name = parts[0].split(': ')[1]
-
-				# Parse test date
-				line_date_str = parts[1]
-				line_date = datetime.datetime.strptime(line_date_str, '%Y-%m-%d %H:%M:%S')
-
-				line_result = float(parts[2])
-				line_unit = parts[3]
-				line_status = parts[4]
-
-				# Parse result date if available
-				result_date_str = parts[5] if len(parts) > 5 else None
-				result_date = datetime.datetime.strptime(result_date_str,
-				                                         '%Y-%m-%d %H:%M:%S') if result_date_str else None
-
-				if patient_id and line_id != patient_id:
-					continue
-				if test_name and line_test_name != test_name:
-					continue
-				if status and line_status.lower() != status.lower():
-					continue
-				if start_date and line_date < start_date:
-					continue
-				if end_date and line_date > end_date:
-					continue
-
-				if abnormal_only:
-					test_info = self.tests.get(line_test_name)
-					if test_info:
-						ranges = test_info['range'].split(',')
-						min_val = float(ranges[0][1:]) if ranges[0][0] == '>' else None
-						max_val = float(ranges[1][1:]) if len(ranges) > 1 and ranges[1][0] == '<' else None
-
-						if (min_val and line_result <= min_val) or (max_val and line_result >= max_val):
-							results.append(line.strip())
-				else:
-					results.append(line.strip())
-
-		return results
-
-	def generate_summary(self, records):
-		values = []
-		turnaround_times = []
-
-		for record in records:
-			fields = record.strip().split(', ')
+	def delete_patient_record(self, patient_id, test_name):
+		aggregates = self._fresh_aggregates()
+		old_records = self._key_records(patient_id, test_name) if aggregates is not None else []
+		if self.journal is not None:
+			deleted = self.record_exists(patient_id, test_name)
+			if deleted:
+				if self.store is not None:
+					self.store.remove(patient_id, test_name)
+				self.journal.append('D', patient_id, test_name)
+		else:
+			deleted = self._rewrite_records(patient_id, test_name, None)
+		if deleted and aggregates is not None:
+			for record in old_records:
+				aggregates.remove(record)
+		self._records_changed([patient_id])
 
-			if len(fields) < 6:
-				print(f"Skipping record due to insufficient fields: {record}")
-				continue
+		if not deleted:
+			print(f"No record found for Patient ID: {patient_id} and Test Name: {test_name}.")
+		return deleted
+
+	def _rewrite_records(self, patient_id, test_name, new_line):
+		# Replaces (or drops, when new_line is None) every line for the patient/test pair
+		store = self._current_store()
+		if store is not None:
+			if new_line is None:
+				store.remove(patient_id, test_name)
+			else:
+				store.replace(patient_id, test_name, new_line)
+		return self.storage.replace(patient_id, test_name, new_line)
+
+	def _key_records(self, patient_id, test_name):
+		store = self._current_store()
+		if store is not None:
+			return store.find(patient_id, test_name)
+		return [record for record in self._read_records(patient_id=patient_id, test_name=test_name)
+		        if record.key == (patient_id, test_name)]
+
+	def _records_changed(self, patient_ids):
+		self.table = None
+		if self.store is not None:
+			# The store already holds our own write
+			self.store_signature = self._signature()
+		if self.aggregates is not None:
+			self.aggregates_signature = self._signature()
+		if self.cache is not None:
+			for patient_id in patient_ids:
+				self.cache.invalidate(patient_id)
+			# Our own write changed the file, but only these patients' timelines are stale
+			self.cache.signature = self._signature()
+
+	def _signature(self):
+		journal = file_signature(self.journal.path) if self.journal is not None else None
+		return self.storage.signature(), journal
+
+	def _current_store(self):
+		# The resident store, or None without in_memory; reloaded when the records changed since it was loaded
+		# or last written through, so writes by other processes or systems are seen
+		if self.store is not None:
+			signature = self._signature()
+			if signature != self.store_signature:
+				self.store = RecordStore.load(self._read_lines())
+				self.store_signature = signature
+		return self.store
+
+	def _current_aggregates(self):
+		# The running aggregates, or None without aggregates=True; (re)built from the records when missing or
+		# when the records changed other than through this system
+		if not self.use_aggregates:
+			return None
+		if self._fresh_aggregates() is None:
+			signature = self._signature()
+			store = self._current_store()
+			self.aggregates = RunningAggregates(store.find() if store is not None else self._read_records())
+			self.aggregates_signature = signature
+		return self.aggregates
+
+	def _fresh_aggregates(self):
+		# The aggregates if they are built and current; stale ones are dropped rather than written through
+		if self.aggregates is not None and self.aggregates_signature != self._signature():
+			self.aggregates = None
+		return self.aggregates
+
+	def compact(self):
+		if self.journal is not None:
+			self.journal.compact()
+			if self.cache is not None:
+				self.cache.signature = self._signature()
+			if self.store is not None:
+				self.store_signature = self._signature()
+			if self.aggregates is not None:
+				self.aggregates_signature = self._signature()
+
+	def patient_timeline(self, patient_id):
+		# All of a patient's records sorted by test date, served from the LRU cache when enabled
+		if self.cache is not None:
+			timeline = self.cache.get(patient_id, self._signature())
+			if timeline is not None:
+				return timeline
+		store = self._current_store()
+		if store is not None:
+			timeline = store.find(patient_id=patient_id)
+		else:
+			timeline = list(self._read_records(patient_id=patient_id))
+		timeline.sort(key=lambda record: record.test_date)
+		if self.cache is not None:
+			self.cache.put(patient_id, timeline)
+		return timeline
 
-			# Extract and validate test value
-			try:
-				test_value_str = fields[2].strip()  # Assuming test value is in the third position
-				test_value = float(test_value_str)
-				values.append(test_value)
-				print(f"Added test value: {test_value}")
-			except ValueError:
-				print(f"Invalid test value: {test_value_str}")
-				continue
+	def filter_tests(self, patient_id=None, test_name=None, abnormal_only=False,
+	                 start_date=None, end_date=None, status=None):
+		return list(self.iter_filter_tests(patient_id, test_name, abnormal_only, start_date, end_date, status))
+
+	def iter_filter_tests(self, patient_id=None, test_name=None, abnormal_only=False,
+	                      start_date=None, end_date=None, status=None):
+		# Generator form of filter_tests: matching lines are yielded as they are read, never collected
+		if self.columnar:
+			table = self.get_table()
+			yield from table.select(table.mask(patient_id, test_name, abnormal_only, start_date, end_date, status,
+			                                   self.tests))
+			return
 
-			# Extract and convert turnaround time
-			try:
-				end_time = datetime.datetime.strptime(fields[1].strip(), '%Y-%m-%d %H:%M:%S')
-				start_time = datetime.datetime.strptime(fields[5].strip(), '%Y-%m-%d %H:%M:%S')
-				turnaround_time = end_time - start_time
-				turnaround_times.append(turnaround_time)
-				print(f"Added turnaround time: {turnaround_time}")
-			except ValueError:
-				print(f"Invalid date format: {fields[1]} or {fields[5]}")
-				continue
+		if self._use_parallel_scan(patient_id, test_name):
+			for records in self._parallel_scan(None, patient_id, test_name, abnormal_only, start_date, end_date,
+			                                   status):
+				yield from records
+			return
 
-		# Calculate statistics for test values
-		if values:
-			min_val = min(values)
-			max_val = max(values)
-			avg_val = sum(values) / len(values)
+		store = self._current_store()
+		if self.cache is not None and patient_id:
+			candidates = self.patient_timeline(patient_id)
+		elif store is not None:
+			candidates = store.find(patient_id, test_name)
+		elif self.journal is None and isinstance(self.storage, SQLiteRecordStorage):
+			candidates = map(PatientRecord.parse, self.storage.query(patient_id, test_name, start_date, end_date, status))
+		else:
+			candidates = self._read_records(start_date, end_date, patient_id, test_name)
+
+		for record in candidates:
+			if record_matches(record, self.tests, patient_id, test_name, abnormal_only, start_date, end_date, status):
+				yield record
+
+	def is_abnormal(self, test_name, results):
+		# Classifies a batch of result values for one test against its compiled range
+		definition = self.tests.get(test_name)
+		if not definition or not definition.bounds:
+			return [False] * len(results)
+		return definition.bounds.classify([float(result) for result in results])
+
+	def get_table(self):
+		# Built lazily and dropped on every write, here or by another process, so it always reflects the record
+		# file; with a snapshot, a current one is mapped instead and a stale one regenerated
+		if self.table is not None and self.table_signature != self._signature():
+			self.table = None
+		if self.table is None:
+			self.table_signature = self._signature()
+		if self.table is None and self.snapshot is not None:
+			loaded = self.snapshot.load(self._snapshot_source())
+			if loaded is not None:
+				self.table = loaded[1]
+		if self.table is None:
+			store = self._current_store()
+			self.table = RecordTable(store.find() if store is not None else self._read_records())
+			if self.snapshot is not None:
+				self.snapshot.save(self._snapshot_source(), self.tests, self.table)
+		return self.table
+
+	def _snapshot_source(self):
+		return repr((self._signature(), file_signature(self.test_file)))
+
+	def summarize(self, patient_id=None, test_name=None, abnormal_only=False, start_date=None, end_date=None,
+	              status=None):
+		# The aggregates answer one patient, one test, everything, or whole days of everything; they are only
+		# built or checked for queries of those shapes
+		if start_date or end_date:
+			answerable = not (patient_id or test_name) and whole_days(start_date, end_date)
 		else:
-			min_val = max_val = avg_val = None
-
-		# Calculate statistics for turnaround times
-		if turnaround_times:
-			min_ta = min(turnaround_times)
-			max_ta = max(turnaround_times)
-			avg_ta = sum(turnaround_times, datetime.timedelta()) / len(turnaround_times)
-
-		#Start with timedelta() = 0 days, 0:00:00
-		# 0 days, 0:00:00 + 2 days, 5:30:00 = 2 days, 5:30:00
-		#2 days, 5:30:00 + 1 day, 3:45:00 = 3 days, 9:15:00
-		#3 days, 9:15:00 + 3 days, 7:15:00 = 6 days, 16:30:00
+			answerable = not (patient_id and test_name)
+		aggregates = self._current_aggregates() if answerable and not (abnormal_only or status) else None
+		if aggregates is not None:
+			if start_date or end_date:
+				return aggregates.summary_for_days(start_date and start_date.date(), end_date and end_date.date())
+			if patient_id:
+				return aggregates.summary('patient_id', patient_id)
+			if test_name:
+				return aggregates.summary('test_name', test_name)
+			return aggregates.total()
+		if self.columnar:
+			table = self.get_table()
+			return table.summary(table.mask(patient_id, test_name, abnormal_only, start_date, end_date, status,
+			                                self.tests))
+		if not abnormal_only and self.journal is None and isinstance(self.storage, SQLiteRecordStorage):
+			return self.storage.summary(patient_id, test_name, start_date, end_date, status)
+		if self._use_parallel_scan(patient_id, test_name):
+			summary = SummaryAccumulator()
+			for partial in self._parallel_scan(SummaryAccumulator, patient_id, test_name, abnormal_only, start_date, end_date, status):
+				summary.merge(partial)
+			return summary.result()
+		return self.generate_summary(self.iter_filter_tests(patient_id, test_name, abnormal_only, start_date,
+		                                                    end_date, status))
+
+	def distribution(self, patient_id=None, test_name=None, abnormal_only=False, start_date=None, end_date=None,
+	                 status=None, bins=10):
+		# Per test name: the summarize() statistics plus median, p90, p99, standard deviation and histograms
+		# of values and turnaround times, from bounded-memory sketches
+		summary = DistributionSummary()
+		if self._use_parallel_scan(patient_id, test_name):
+			for partial in self._parallel_scan(DistributionSummary, patient_id, test_name, abnormal_only, start_date,
+			                                   end_date, status):
+				summary.merge(partial)
 		else:
-			min_ta = max_ta = avg_ta = None
+			for record in self.iter_filter_tests(patient_id, test_name, abnormal_only, start_date, end_date, status):
+				summary.add(record)
+		return summary.result(bins)
+
+	def group_summary(self, group_by, patient_id=None, test_name=None, abnormal_only=False, start_date=None,
+	                  end_date=None, status=None):
+		# generate_summary statistics for every test name, patient ID, status, test-date day or month in
+		# the selection, from one pass over the records (none when running aggregates already hold them)
+		summary = GroupedSummary(group_by)
+		filtered = patient_id or test_name or abnormal_only or start_date or end_date or status
+		aggregates = self._current_aggregates() if not filtered and group_by != 'status' else None
+		if aggregates is not None:
+			grouping = 'day' if group_by == 'month' else group_by
+			empty = SummaryAccumulator()
+			for key, count in aggregates.counts[grouping].items():
+				group = aggregates.groups[grouping].get(key, empty)
+				if grouping == 'day':
+					key = key.strftime('%Y-%m' if group_by == 'month' else '%Y-%m-%d')
+				# Copied, so the running aggregates are never merged into
+				summary.groups.setdefault(key, SummaryAccumulator()).merge(group)
+				summary.counts[key] += count
+			return summary.result()
+		if self._use_parallel_scan(patient_id, test_name):
+			for partial in self._parallel_scan(functools.partial(GroupedSummary, group_by), patient_id, test_name,
+			                                   abnormal_only, start_date, end_date, status):
+				summary.merge(partial)
+		else:
+			for record in self.iter_filter_tests(patient_id, test_name, abnormal_only, start_date, end_date, status):
+				summary.add(record)
+		return summary.result()
+
+	def _use_parallel_scan(self, patient_id=None, test_name=None):
+		# A patient's lines, or with the offset index a test's, are found faster by the index, the timeline
+		# cache or the mmap prefilter than by splitting the file across processes
+		return (self.workers > 1 and self.store is None and self.journal is None and not self.columnar
+		        and type(self.storage) is RecordFile and not patient_id
+		        and not (test_name and self.storage.index is not None)
+		        and os.path.getsize(self.storage.path) >= PARALLEL_SCAN_MIN_BYTES)
+
+	def _parallel_scan(self, summarize, *criteria):
+		# Splits the record file into byte ranges; results come back in file order
+		size = os.path.getsize(self.storage.path)
+		chunk_size = max(size // (self.workers * 4) + 1, PARALLEL_SCAN_MIN_BYTES // 4)
+		starts = range(0, size, chunk_size)
+		ends = [min(start + chunk_size, size) for start in starts]
+		count = len(starts)
+		with ProcessPoolExecutor(self.workers) as pool:
+			yield from pool.map(scan_chunk, [self.storage.path] * count, starts, ends, [self.tests] * count,
+			                    [summarize] * count, [criteria] * count)
+
+	def _read_lines(self, start_date=None, end_date=None, patient_id=None, test_name=None):
+		if self.journal is not None:
+			return self.journal.read_lines(start_date, end_date, patient_id, test_name)
+		return self.storage.read_lines(start_date, end_date, patient_id, test_name)
+
+	def _read_records(self, start_date=None, end_date=None, patient_id=None, test_name=None):
+		for line in self._read_lines(start_date, end_date, patient_id, test_name):
+			yield PatientRecord.parse(line)
 
-		return {
-			'min_val': min_val,
-			'max_val': max_val,
-			'avg_val': avg_val,
-			'min_ta': min_ta,
-			'max_ta': max_ta,
-			'avg_ta': avg_ta
-		}
+	def generate_summary(self, records):
+		# Consumes records one at a time, so a generator from iter_filter_tests is summarised in O(1) memory
+		summary = SummaryAccumulator()
+		for record in records:
+			summary.add(record)
+		return summary.result()
 
 	def record_exists(self, patient_id, test_name):
-		with open(self.record_file, 'r') as file:
-			for line in file:
-				if line.startswith(f"{patient_id}: {test_name},"):
-					return True
-		return False
+		store = self._current_store()
+		if store is not None:
+			return store.exists(patient_id, test_name)
+		prefix = f"{patient_id}: {test_name},"
+		return any(line.startswith(prefix) for line in self._read_lines(patient_id=patient_id, test_name=test_name))
 
 
 def is_valid_test_name(name):
@@ -186,29 +1854,13 @@ def is_valid_test_name(name):
 
 
 def is_valid_range(range_str):
-	# Pattern to match >value, <value, or >value,<value in any order
-	pattern = r'^((>(-?\d+(\.\d+)?))?(,(<(-?\d+(\.\d+)?)))?|((<(-?\d+(\.\d+)?))?(,(>(-?\d+(\.\d+)?)))?))$'
-
-	if not re.match(pattern, range_str):
+	bounds = ReferenceRange.parse(range_str)
+	if bounds is None:
 		return False
 
-	# Extract the numeric values for validation
-	lower_limit = None
-	upper_limit = None
-
-	if '>' in range_str:
-		lower_limit_str = re.search(r'>(-?\d+(\.\d+)?)', range_str)
-		if lower_limit_str:
-			lower_limit = float(lower_limit_str.group(1))
-
-	if '<' in range_str:
-		upper_limit_str = re.search(r'<(-?\d+(\.\d+)?)', range_str)
-		if upper_limit_str:
-			upper_limit = float(upper_limit_str.group(1))
-
 	# Ensure that lower limit is less than upper limit
-	if lower_limit is not None and upper_limit is not None:
-		if lower_limit >= upper_limit:
+	if bounds.lower is not None and bounds.upper is not None:
+		if bounds.lower >= bounds.upper:
 			return False
 
 	return True
@@ -223,12 +1875,11 @@ def is_valid_turnaround_time(ta_time):
 
 
 def is_valid_status(status):
-	valid_statuses = {'pending', 'completed', 'reviewed'}
-	return status.lower() in valid_statuses
+	return status.lower() in VALID_STATUSES
 
 
 def is_valid_unit(unit, tests):
-	valid_units = {test_info['unit'] for test_info in tests.values()}
+	valid_units = {definition.unit for definition in tests.values()}
 	if unit not in valid_units:
 		print(f"Invalid unit. Valid units are: {', '.join(valid_units)}")
 	return unit in valid_units
@@ -239,17 +1890,15 @@ def is_valid_patient_id(patient_id):
 
 
 def is_valid_result(result_str):
-	return bool(re.match(r'^-?\d+(\.\d+)?$', result_str))
+	return RESULT_PATTERN.fullmatch(result_str) is not None
 
 
 def is_valid_date(date_str):
-	for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
-		try:
-			datetime.datetime.strptime(date_str, fmt)
-			return True
-		except ValueError:
-			continue
-	return False
+	try:
+		parse_timestamp(date_str)
+		return True
+	except ValueError:
+		return False
 
 
 def add_or_update_test(system, test_name, range_str, unit, turnaround_time):
@@ -290,11 +1939,11 @@ def add_or_update_patient_record(system, patient_id, test_name, test_date_str, r
 		print("Invalid status. Valid statuses are: pending, completed, reviewed.")
 		return
 
-	test_date = datetime.datetime.strptime(test_date_str, '%Y-%m-%d %H:%M:%S')
+	test_date = parse_timestamp(test_date_str)
 	result = float(result_str)
 
 	if status == 'completed' and result_date_str:
-		result_date = datetime.datetime.strptime(result_date_str, '%Y-%m-%d %H:%M:%S')
+		result_date = parse_timestamp(result_date_str)
 		if result_date <= test_date:
 			print("Result date must be after the test date.")
 			return
@@ -333,7 +1982,10 @@ def test_name_exists(test_name, test_file):
 
 
 def main():
-	system = MedicalRecordSystem()
+	# The sidecar index keeps lookups O(k) and is re-validated against the record file on every read, so
+	# records written by other processes are seen. Unfiltered, per-patient and per-test summaries come from the
+	# running aggregates, built on the first summary and rebuilt when another process changed the records
+	system = MedicalRecordSystem(indexed=True, aggregates=True)
 
 	while True:
 		print("~~~~~~~~~~~Medical Record Management System~~~~~~~~~~~")
@@ -353,15 +2005,6 @@ def main():
 
 			if test_name in system.tests:
 				print(f"Test {test_name} already exists. It will be updated.")
-				with open(system.test_file, 'r') as file:
-					lines = file.readlines()
-
-				with open(system.test_file, 'w') as file:
-					for line in lines:
-						if not line.startswith(f"{test_name};"):
-							file.write(line)
-						else:
-							print(f"Deleted existing record for test: {test_name}")
 
 			range_str = input("Enter test range (e.g., '>13.8,<17.2'): ")
 			while not is_valid_range(range_str):
@@ -373,7 +2016,7 @@ def main():
 			while not is_valid_turnaround_time(turnaround_time):
 				turnaround_time = input("Invalid turnaround time. Enter again: ")
 
-			system.add_test(test_name, range_str, unit, turnaround_time)
+			system.replace_test(test_name, range_str, unit, turnaround_time)
 			print("Test updated successfully.")
 
 		elif choice == '2':
@@ -444,7 +2087,7 @@ def main():
 			unit = input("Enter new result unit (Expected unit: mg/dL): ")
 			while not is_valid_unit(unit, system.tests):
 				unit = input(
-					f"Invalid unit. Expected one of: {[test['unit'] for test in system.tests.values()]}. Enter again: ")
+					f"Invalid unit. Expected one of: {[test.unit for test in system.tests.values()]}. Enter again: ")
 
 			status = input("Enter new test status (Pending/Completed/Reviewed): ").lower()
 			while not is_valid_status(status):
@@ -472,15 +2115,6 @@ def main():
 
 			if test_name in system.tests:
 				print(f"Test {test_name} found. It will be updated.")
-				with open(system.test_file, 'r') as file:
-					lines = file.readlines()
-
-				with open(system.test_file, 'w') as file:
-					for line in lines:
-						if not line.startswith(f"{test_name};"):
-							file.write(line)
-						else:
-							print(f"Deleted existing record for test: {test_name}")
 
 			else:
 				print(f"Test {test_name} not found. A new test will be added.")
@@ -495,7 +2129,7 @@ def main():
 			while not is_valid_turnaround_time(turnaround_time):
 				turnaround_time = input("Invalid turnaround time. Enter again: ")
 
-			system.add_test(test_name, range_str, unit, turnaround_time)
+			system.replace_test(test_name, range_str, unit, turnaround_time)
 			print("Test updated successfully.")
 
 		elif choice == '5':
@@ -554,11 +2188,39 @@ def main():
 				print("End date must be greater than start date. Please enter valid dates.")
 				continue
 
-			records = system.filter_tests(patient_id=patient_id, test_name=test_name, start_date=start_date,
-			                              end_date=end_date)
-			summary = system.generate_summary(records)
+			group_by = input(f"Group by ({', '.join(GROUP_BY)}) (or press enter for a single summary): ").strip()
+			if group_by:
+				if group_by not in GROUP_BY:
+					print(f"Invalid grouping. Choose one of: {', '.join(GROUP_BY)}")
+					continue
+				rows = system.group_summary(group_by, patient_id=patient_id, test_name=test_name,
+				                            start_date=start_date, end_date=end_date)
+				print(f"{group_by:<12} {'count':>7} {'min_val':>10} {'max_val':>10} {'avg_val':>10} "
+				      f"{'min_ta':>18} {'max_ta':>18} {'avg_ta':>18}")
+				for row in rows:
+					values = [format_result(row[name]) if row[name] is not None else '-'
+					          for name in ('min_val', 'max_val')]
+					values.append(f"{row['avg_val']:.2f}" if row['avg_val'] is not None else '-')
+					turnarounds = [str(row[name]).split('.')[0] if row[name] is not None else '-'
+					               for name in ('min_ta', 'max_ta', 'avg_ta')]
+					print(f"{row[group_by]:<12} {row['count']:>7} {values[0]:>10} {values[1]:>10} {values[2]:>10} "
+					      f"{turnarounds[0]:>18} {turnarounds[1]:>18} {turnarounds[2]:>18}")
+				continue
+
+			summary = system.summarize(patient_id=patient_id, test_name=test_name, start_date=start_date,
+			                           end_date=end_date)
 			print(summary)
 
+			if input("Show percentiles and histograms per test? (y/n): ").lower() == 'y':
+				distribution = system.distribution(patient_id=patient_id, test_name=test_name,
+				                                   start_date=start_date, end_date=end_date)
+				for name, result in distribution.items():
+					print(f"{name}: median {result['median_val']}, p90 {result['p90_val']}, p99 {result['p99_val']}, "
+					      f"std {result['std_val']}; turnaround median {result['median_ta']}, p90 {result['p90_ta']}, "
+					      f"p99 {result['p99_ta']}, std {result['std_ta']}")
+					for low, high, count in result['histogram_val']:
+						print(f"  {low:.2f} - {high:.2f}: {count}")
+
 		elif choice == '7':
 			print("----End of the Medical Test Management System.")
 			break
@@ -0,0 +1,185 @@
+import argparse
+import collections
+
+from PPPPProject2 import MedicalRecordSystem, format_result
+
+SECONDS_PER_DAY = 86400.0
+
+
+class DeltaThreshold:
+	# The largest allowed change between consecutive results of a test: absolute ("30") or relative to
+	# the previous result ("25%")
+	__slots__ = ('limit', 'relative')
+
+	def __init__(self, text):
+		text = text.strip()
+		self.relative = text.endswith('%')
+		self.limit = float(text[:-1] if self.relative else text)
+		if self.limit < 0:
+			raise ValueError(f"Delta threshold must not be negative: {text}")
+
+	def exceeded(self, previous, current):
+		change = abs(current - previous)
+		if not self.relative:
+			return change > self.limit
+		if previous == 0:
+			return change > 0
+		return change / abs(previous) * 100 > self.limit
+
+	def __str__(self):
+		return f"{format_result(self.limit)}{'%' if self.relative else ''}"
+
+
+class SeriesState:
+	# What is kept per (patient, test): the latest result and the running sums of a least-squares fit of
+	# result against days since the first result, so the slope never needs the history
+	__slots__ = ('origin', 'last_date', 'last_value', 'count', 'sum_t', 'sum_y', 'sum_tt', 'sum_ty')
+
+	def __init__(self, record):
+		self.origin = record.test_date
+		self.last_date = None
+		self.last_value = None
+		self.count = 0
+		self.sum_t = self.sum_y = self.sum_tt = self.sum_ty = 0.0
+
+	def add(self, record, sign=1):
+		t = (record.test_date - self.origin).total_seconds() / SECONDS_PER_DAY
+		self.count += sign
+		self.sum_t += sign * t
+		self.sum_y += sign * record.result
+		self.sum_tt += sign * t * t
+		self.sum_ty += sign * t * record.result
+		if sign > 0 and (self.last_date is None or record.test_date >= self.last_date):
+			self.last_date = record.test_date
+			self.last_value = record.result
+
+	def remove(self, record):
+		# Takes a record back out of the fit; the latest result is left for the caller's next add()
+		self.add(record, -1)
+
+	def slope(self):
+		# Change in result per day, or None until there are two distinct test dates
+		denominator = self.count * self.sum_tt - self.sum_t * self.sum_t
+		if self.count < 2 or abs(denominator) < 1e-12:
+			return None
+		return (self.count * self.sum_ty - self.sum_t * self.sum_y) / denominator
+
+
+class TrendAnalyzer:
+	# Per-patient, per-test delta checks and trend slopes, updated record by record. prime() streams the
+	# existing records once in file order; attach() then feeds it every record added through the system.
+	# A record older than the latest one already seen for its patient/test still counts towards the slope,
+	# but is not delta-checked, since its predecessor is no longer known. The record file keeps one result per
+	# patient/test, so an update with a new test date is a new result: it is delta-checked against the one it
+	# replaced, which stays in the series. An update with the same test date corrects that result instead:
+	# the old value is retracted from the fit and the correction is not delta-checked
+	def __init__(self, system, thresholds=None, max_violations=10000, on_violation=None):
+		self.system = system
+		self.thresholds = {name: DeltaThreshold(value) if isinstance(value, str) else value
+		                   for name, value in (thresholds or {}).items()}
+		self.series = {}
+		self.violations = collections.deque(maxlen=max_violations)
+		self.on_violation = on_violation
+		self.out_of_order = 0
+
+	def prime(self):
+		for record in self.system.iter_filter_tests():
+			self.observe(record)
+		return len(self.series)
+
+	def attach(self):
+		self.system.add_listener(self.observe)
+
+	def observe(self, record, previous=None):
+		# Returns the violation this record raised, if any
+		key = (record.patient_id, record.test_name)
+		state = self.series.get(key)
+		if state is None:
+			state = self.series[key] = SeriesState(record)
+		elif previous is not None and previous.test_date == record.test_date and state.count:
+			state.remove(previous)
+			state.add(record)
+			return None
+		violation = None
+		threshold = self.thresholds.get(record.test_name)
+		if state.last_date is not None and record.test_date < state.last_date:
+			self.out_of_order += 1
+		elif threshold is not None and state.last_value is not None \
+				and threshold.exceeded(state.last_value, record.result):
+			violation = {
+				'patient_id': record.patient_id,
+				'test_name': record.test_name,
+				'previous_date': state.last_date,
+				'previous': state.last_value,
+				'test_date': record.test_date,
+				'result': record.result,
+				'change': record.result - state.last_value,
+				'threshold': str(threshold)
+			}
+			self.violations.append(violation)
+			if self.on_violation is not None:
+				self.on_violation(violation)
+		state.add(record)
+		return violation
+
+	def trends(self, patient_id=None, test_name=None):
+		rows = []
+		for (series_patient, series_test), state in sorted(self.series.items()):
+			if (patient_id and series_patient != patient_id) or (test_name and series_test != test_name):
+				continue
+			rows.append({
+				'patient_id': series_patient,
+				'test_name': series_test,
+				'count': state.count,
+				'last_date': state.last_date,
+				'last_value': state.last_value,
+				'slope_per_day': state.slope()
+			})
+		return rows
+
+
+def print_violation(violation):
+	print(f"Delta check: {violation['patient_id']}: {violation['test_name']} changed by "
+	      f"{format_result(round(violation['change'], 6))} (limit {violation['threshold']}) from "
+	      f"{format_result(violation['previous'])} on {violation['previous_date']:%Y-%m-%d %H:%M:%S} to "
+	      f"{format_result(violation['result'])} on {violation['test_date']:%Y-%m-%d %H:%M:%S}")
+
+
+def parse_thresholds(values):
+	thresholds = {}
+	for value in values:
+		name, separator, limit = value.rpartition('=')
+		if not separator or not name:
+			raise ValueError(f"Expected TEST=LIMIT, got: {value}")
+		thresholds[name] = DeltaThreshold(limit)
+	return thresholds
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Delta checks and result trends per patient and test.")
+	parser.add_argument('--test-file', default='medicalTest.txt')
+	parser.add_argument('--record-file', default='medicalRecord.txt')
+	parser.add_argument('--partitioned', action='store_true',
+	                    help="records are kept in per-month partitions (<record file stem>.parts/)")
+	parser.add_argument('--threshold', action='append', default=[], metavar='TEST=LIMIT',
+	                    help="largest allowed change between consecutive results, e.g. LDL=30 or BGT=25%%")
+	parser.add_argument('--patient-id', help="only print trends for this patient")
+	parser.add_argument('--test-name', help="only print trends for this test")
+	args = parser.parse_args()
+
+	try:
+		thresholds = parse_thresholds(args.threshold)
+	except ValueError as e:
+		parser.error(str(e))
+	system = MedicalRecordSystem(args.test_file, args.record_file, partitioned=args.partitioned)
+	analyzer = TrendAnalyzer(system, thresholds, on_violation=print_violation)
+	analyzer.prime()
+	print(f"{len(analyzer.violations)} delta check violations")
+	for row in analyzer.trends(args.patient_id, args.test_name):
+		slope = f"{row['slope_per_day']:+.4f}/day" if row['slope_per_day'] is not None else '-'
+		print(f"{row['patient_id']}: {row['test_name']}, {row['count']} results, last "
+		      f"{format_result(row['last_value'])} on {row['last_date']:%Y-%m-%d %H:%M:%S}, trend {slope}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from PPPPProject2 import MedicalRecordSystem
+
+UNITS = ('mg/dL', 'mm Hg', 'mmol/L', 'g/dL', 'U/L', '%')
+STATUSES = ('Pending', 'Completed', 'Reviewed')
+
+
+def generate_tests(path, count, rng):
+	# Writes a medicalTest.txt catalogue; returns {name: (low, high, unit)} for the record generator
+	tests = {}
+	with open(path, 'w') as file:
+		for number in range(count):
+			name = f"T{number:04d}"
+			unit = UNITS[number % len(UNITS)]
+			low = rng.randint(1, 100)
+			high = low + rng.randint(10, 100)
+			kind = number % 3
+			if kind == 0:
+				range_str = f">{low},<{high}"
+			elif kind == 1:
+				range_str = f"<{high}"
+			else:
+				range_str = f">{low}"
+			turnaround = f"{rng.randint(0, 3):02d}-{rng.randint(0, 23):02d}-{rng.randint(0, 59):02d}"
+			file.write(f"{name};{range_str};{unit};{turnaround}\n")
+			tests[name] = (low, high, unit)
+	return tests
+
+
+def generate_records(path, rows, patients, tests, rng, first_day=datetime.datetime(2023, 1, 1), days=730):
+	# Writes a medicalRecord.txt with rows lines spread over the given number of patients; results are drawn
+	# around each test's range so roughly one in six falls outside it
+	names = list(tests)
+	patient_ids = [f"{1000000 + number * 7919 % 9000000:07d}" for number in range(patients)]
+	with open(path, 'w', buffering=1 << 20) as file:
+		for _ in range(rows):
+			name = names[rng.randrange(len(names))]
+			low, high, unit = tests[name]
+			test_date = first_day + datetime.timedelta(minutes=rng.randrange(days * 24 * 60))
+			result = round(rng.gauss((low + high) / 2, (high - low) / 2.8), 1)
+			status = STATUSES[rng.randrange(3)]
+			line = (f"{patient_ids[rng.randrange(patients)]}: {name}, {test_date:%Y-%m-%d %H:%M:%S}, {result}, {unit}, "
+			        f"{status}")
+			if status != 'Pending':
+				result_date = test_date + datetime.timedelta(minutes=rng.randint(30, 5 * 24 * 60))
+				line += f", {result_date:%Y-%m-%d %H:%M:%S}"
+			file.write(line + "\n")
+	return patient_ids
+
+
+def measure(function, repeat):
+	# Best-of-repeat wall time, then one extra run under tracemalloc for the peak allocation
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		function()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	tracemalloc.start()
+	try:
+		function()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return best, peak
+
+
+def filter_cases(patient_id, test_name, first_day):
+	month = (first_day + datetime.timedelta(days=180), first_day + datetime.timedelta(days=210))
+	return {
+		'filter_all': {},
+		'filter_patient': {'patient_id': patient_id},
+		'filter_test': {'test_name': test_name},
+		'filter_patient_test': {'patient_id': patient_id, 'test_name': test_name},
+		'filter_abnormal': {'abnormal_only': True},
+		'filter_test_abnormal': {'test_name': test_name, 'abnormal_only': True},
+		'filter_date_range': {'start_date': month[0], 'end_date': month[1]},
+		'filter_status': {'status': 'completed'},
+		'filter_patient_abnormal_date_status': {'patient_id': patient_id, 'abnormal_only': True,
+		                                        'start_date': month[0], 'end_date': month[1], 'status': 'completed'}
+	}
+
+
+def run_size(directory, rows, args, rng):
+	test_file = os.path.join(directory, 'medicalTest.txt')
+	record_file = os.path.join(directory, 'medicalRecord.txt')
+	# Partitions and a journal left by the previous size would be read in place of, or over, the new records
+	shutil.rmtree(os.path.splitext(record_file)[0] + '.parts', ignore_errors=True)
+	with contextlib.suppress(FileNotFoundError):
+		os.remove(record_file + '.journal')
+	tests = generate_tests(test_file, args.tests, rng)
+	start = time.perf_counter()
+	patient_ids = generate_records(record_file, rows, args.patients, tests, rng)
+	generation = time.perf_counter() - start
+
+	options = {'in_memory': args.in_memory, 'columnar': args.columnar, 'journal': args.journal,
+	           'workers': args.workers, 'indexed': args.indexed, 'snapshot': args.snapshot,
+	           'partitioned': args.partitioned}
+	start = time.perf_counter()
+	system = MedicalRecordSystem(test_file, record_file, **options)
+	startup = time.perf_counter() - start
+
+	patient_id = patient_ids[0]
+	test_name = next(iter(tests))
+	first_day = datetime.datetime(2023, 1, 1)
+	results = [{'benchmark': 'generate', 'seconds': generation, 'rows_per_second': rows / generation},
+	           {'benchmark': 'startup', 'seconds': startup, 'rows_per_second': rows / startup}]
+
+	def record(name, function, operations=1, scanned=rows):
+		seconds, peak = measure(function, args.repeat)
+		results.append({
+			'benchmark': name,
+			'seconds': seconds,
+			'ops_per_second': operations / seconds if seconds else None,
+			'rows_per_second': scanned / seconds if seconds else None,
+			'peak_bytes': peak
+		})
+
+	record('load_tests', system.load_tests, scanned=len(tests))
+	for name, criteria in filter_cases(patient_id, test_name, first_day).items():
+		record(name, lambda criteria=criteria: system.filter_tests(**criteria))
+	record('generate_summary', lambda: system.generate_summary(system.iter_filter_tests()))
+	record('generate_summary_test', lambda: system.generate_summary(system.iter_filter_tests(test_name=test_name)))
+	lookups = [(patient_ids[rng.randrange(len(patient_ids))], test_name) for _ in range(args.lookups)]
+	record('record_exists', lambda: [system.record_exists(*key) for key in lookups], operations=len(lookups),
+	       scanned=rows * len(lookups))
+	# Each run rewrites the same record with a new result, so repeats stay comparable
+	update = {'test_date': '2023-06-01 08:00:00', 'result': '50.0', 'unit': tests[test_name][2],
+	          'status': 'Completed', 'result_date': '2023-06-01 09:00:00'}
+	system.add_patient_record(patient_id, test_name, update['test_date'], update['result'], update['unit'],
+	                          update['status'], update['result_date'])
+	record('update_patient_record', lambda: system.update_patient_record(patient_id, test_name, update))
+
+	for result in results:
+		result['rows'] = rows
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the Medical Record Management System on synthetic data.")
+	parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+	                    help="record file sizes to generate (e.g. 10000 1000000 10000000)")
+	parser.add_argument('--patients', type=int, default=5000)
+	parser.add_argument('--tests', type=int, default=15)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--lookups', type=int, default=100, help="record_exists calls per timed run")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--in-memory', action='store_true')
+	parser.add_argument('--columnar', action='store_true')
+	parser.add_argument('--journal', action='store_true')
+	parser.add_argument('--indexed', action='store_true')
+	parser.add_argument('--snapshot', action='store_true')
+	parser.add_argument('--partitioned', action='store_true')
+	parser.add_argument('--workers', type=int, default=0)
+	parser.add_argument('--directory', help="where to generate the data (a temporary directory by default)")
+	parser.add_argument('--output', help="write the JSON report here instead of printing it")
+	args = parser.parse_args()
+
+	directory = args.directory or tempfile.mkdtemp(prefix='medical-benchmark-')
+	os.makedirs(directory, exist_ok=True)
+	report = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'started': datetime.datetime.now().isoformat(timespec='seconds'),
+		'options': {name: value for name, value in vars(args).items() if name not in ('directory', 'output')},
+		'results': []
+	}
+	try:
+		# The system reports skipped and missing records with print(); keep that out of the JSON report
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			for rows in args.rows:
+				report['results'].extend(run_size(directory, rows, args, random.Random(args.seed)))
+	finally:
+		if not args.directory:
+			shutil.rmtree(directory, ignore_errors=True)
+
+	text = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as file:
+			file.write(text + "\n")
+	else:
+		print(text)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,38 @@
+import datetime
+
+import pytest
+
+TESTS = "BGT;>70,<99;mg/dL;00-12-06\nLDL;<100;mg/dL;00-17-06\n"
+UPDATE = {'test_date': '2024-02-01 08:00:00', 'result': '120', 'unit': 'mg/dL', 'status': 'Completed',
+          'result_date': '2024-02-01 10:00:00'}
+
+
+def record_line(number, test_name='BGT', result='80'):
+	return (f"{1000000 + number:07d}: {test_name}, 2024-01-01 08:00:00, {result}, mg/dL, Completed, "
+	        f"2024-01-01 10:00:00")
+
+
+def lines_of(path):
+	with open(path, 'r') as file:
+		return [line.strip() for line in file if line.strip()]
+
+
+def mixed_records(record_file):
+	with open(record_file, 'a') as file:
+		file.write("7654321: LDL, 2024-02-03 09:30:00, 130.5, mg/dL, Reviewed, 2024-02-04 10:00:00\n")
+		file.write("7654321: BGT, 2024-02-10 07:00:00, 65, mg/dL, Pending\n")
+		file.write("7654322: LDL, 2024-03-01 08:00:00, 70, mg/dL, completed, 2024-03-01 20:15:00\n")
+
+
+CRITERIA = [{}, {'patient_id': '7654321'}, {'test_name': 'LDL'}, {'abnormal_only': True}, {'status': 'COMPLETED'},
+            {'start_date': datetime.datetime(2024, 2, 1), 'end_date': datetime.datetime(2024, 2, 28)},
+            {'patient_id': '7654321', 'test_name': 'LDL', 'abnormal_only': True}, {'patient_id': '0000000'}]
+
+
+@pytest.fixture
+def files(tmp_path):
+	test_file = tmp_path / 'medicalTest.txt'
+	record_file = tmp_path / 'medicalRecord.txt'
+	test_file.write_text(TESTS)
+	record_file.write_text(''.join(record_line(number) + "\n" for number in range(20)))
+	return str(test_file), str(record_file)
@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from PPPPProject2 import MedicalRecordSystem, parse_timestamp
+
+RECORD_FIELDS = ('patient_id', 'test_name', 'test_date', 'result', 'unit', 'status', 'result_date')
+
+
+class ReadWriteLock:
+	# Any number of readers, or one writer; waiting writers hold back new readers so they can't starve
+	def __init__(self):
+		self.readers = 0
+		self.writing = False
+		self.waiting_writers = 0
+		self.condition = asyncio.Condition()
+
+	@contextlib.asynccontextmanager
+	async def read(self):
+		async with self.condition:
+			await self.condition.wait_for(lambda: not self.writing and not self.waiting_writers)
+			self.readers += 1
+		try:
+			yield
+		finally:
+			async with self.condition:
+				self.readers -= 1
+				self.condition.notify_all()
+
+	@contextlib.asynccontextmanager
+	async def write(self):
+		async with self.condition:
+			self.waiting_writers += 1
+			await self.condition.wait_for(lambda: not self.writing and not self.readers)
+			self.waiting_writers -= 1
+			self.writing = True
+		try:
+			yield
+		finally:
+			async with self.condition:
+				self.writing = False
+				self.condition.notify_all()
+
+
+def parse_date(value):
+	if not value:
+		return None
+	if len(value) == 10:
+		return datetime.datetime.strptime(value, '%Y-%m-%d')
+	return parse_timestamp(value)
+
+
+def record_fields(request):
+	# The record fields as strings; a missing or null field is empty, but a result of 0 stays '0'
+	return ['' if request.get(name) is None else str(request.get(name)) for name in RECORD_FIELDS]
+
+
+def to_json(value):
+	if isinstance(value, datetime.timedelta):
+		return value.total_seconds()
+	return value
+
+
+class MedicalRecordService:
+	# Line-delimited JSON front-end for a MedicalRecordSystem. Each request is one JSON object with an
+	# "op" of add, update, delete, filter, summary or stats; file I/O runs on a thread pool
+	def __init__(self, system, threads=8):
+		self.system = system
+		self.lock = ReadWriteLock()
+		self.executor = ThreadPoolExecutor(threads)
+
+	async def run(self, function, *args, write=False):
+		async with (self.lock.write() if write else self.lock.read()):
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+	async def handle(self, request):
+		if not isinstance(request, dict):
+			return {'ok': False, 'error': "Expected a JSON object"}
+		handler = getattr(self, 'op_' + str(request.get('op')), None)
+		if handler is None:
+			return {'ok': False, 'error': f"Unknown op: {request.get('op')}"}
+		return await handler(request)
+
+	async def op_add(self, request):
+		fields = record_fields(request)
+		error = self.system.validate_record(fields)
+		if error:
+			return {'ok': False, 'error': error}
+		return await self.run(self._add, fields, write=True)
+
+	def _add(self, fields):
+		if self.system.record_exists(fields[0], fields[1]):
+			return {'ok': False, 'error': "Record exists. Use the update op to change it."}
+		self.system.add_patient_record(*fields)
+		return {'ok': True}
+
+	async def op_update(self, request):
+		fields = record_fields(request)
+		error = self.system.validate_record(fields)
+		if error:
+			return {'ok': False, 'error': error}
+		return await self.run(self._update, fields, write=True)
+
+	def _update(self, fields):
+		if not self.system.record_exists(fields[0], fields[1]):
+			return {'ok': False, 'error': f"No record found for Patient ID: {fields[0]} and Test Name: {fields[1]}."}
+		self.system.update_patient_record(fields[0], fields[1], {
+			'test_date': fields[2],
+			'result': fields[3],
+			'unit': fields[4],
+			'status': fields[5],
+			'result_date': fields[6] if len(fields) > 6 else None
+		})
+		return {'ok': True}
+
+	async def op_delete(self, request):
+		deleted = await self.run(self.system.delete_patient_record, request.get('patient_id'),
+		                         request.get('test_name'), write=True)
+		return {'ok': deleted}
+
+	def _criteria(self, request):
+		return {
+			'patient_id': request.get('patient_id') or None,
+			'test_name': request.get('test_name') or None,
+			'abnormal_only': bool(request.get('abnormal_only')),
+			'start_date': parse_date(request.get('start_date')),
+			'end_date': parse_date(request.get('end_date')),
+			'status': request.get('status') or None
+		}
+
+	async def op_filter(self, request):
+		records = await self.run(functools.partial(self.system.filter_tests, **self._criteria(request)))
+		return {'ok': True, 'records': [str(record) for record in records]}
+
+	async def op_summary(self, request):
+		summary = await self.run(functools.partial(self.system.summarize, **self._criteria(request)))
+		return {'ok': True, 'summary': {name: to_json(value) for name, value in summary.items()}}
+
+	async def op_stats(self, request):
+		stats = self.system.stats()
+		if stats is None:
+			return {'ok': False, 'error': "Instrumentation is off; start the service with --stats."}
+		return {'ok': True, 'stats': stats}
+
+	async def serve_client(self, reader, writer):
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				if not line.strip():
+					continue
+				try:
+					response = await self.handle(json.loads(line))
+				except (ValueError, TypeError, KeyError) as e:
+					response = {'ok': False, 'error': str(e)}
+				except Exception as e:
+					# Storage errors (OSError, sqlite3.Error, ...) fail this request, not the connection
+					print(f"Error handling request {line.decode(errors='replace').strip()[:200]}: {e!r}")
+					response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+				writer.write((json.dumps(response) + "\n").encode())
+				await writer.drain()
+		finally:
+			writer.close()
+			with contextlib.suppress(ConnectionError):
+				await writer.wait_closed()
+
+
+async def serve(system, host='127.0.0.1', port=8765, threads=8):
+	service = MedicalRecordService(system, threads)
+	server = await asyncio.start_server(service.serve_client, host, port)
+	print(f"Serving the Medical Record Management System on {host}:{port}")
+	async with server:
+		await server.serve_forever()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve the Medical Record Management System over TCP.")
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--threads', type=int, default=8)
+	parser.add_argument('--test-file', default='medicalTest.txt')
+	parser.add_argument('--record-file', default='medicalRecord.txt')
+	parser.add_argument('--database', help="SQLite database to use instead of the text files")
+	parser.add_argument('--partitioned', action='store_true',
+	                    help="records are kept in per-month partitions (<record file stem>.parts/)")
+	parser.add_argument('--in-memory', action='store_true', help="keep records resident and indexed")
+	parser.add_argument('--indexed', action='store_true', help="keep patient/test offset index files on disk")
+	parser.add_argument('--stats', action='store_true', help="record per-operation call counts and latencies")
+	parser.add_argument('--stats-interval', type=float, default=0, help="print a stats line every N seconds")
+	parser.add_argument('--slow-query', type=float, help="log operations slower than this many seconds")
+	parser.add_argument('--import-text', action='store_true',
+	                    help="load --test-file and --record-file into the --database before serving; records "
+	                         "already stored are skipped")
+	parser.add_argument('--export-text', action='store_true',
+	                    help="write the --database out to --test-file and --record-file, then exit")
+	args = parser.parse_args()
+	if (args.import_text or args.export_text) and not args.database:
+		parser.error("--import-text and --export-text need --database")
+
+	system = MedicalRecordSystem(args.test_file, args.record_file, in_memory=args.in_memory,
+	                             database=args.database, partitioned=args.partitioned, indexed=args.indexed,
+	                             instrument=args.stats or bool(args.stats_interval) or args.slow_query is not None,
+	                             stats_interval=args.stats_interval, slow_query=args.slow_query)
+	if args.export_text:
+		system.export_text(args.record_file, args.test_file)
+		print(f"Exported {args.database} to {args.test_file} and {args.record_file}")
+		return
+	if args.import_text:
+		counts = system.import_text(args.record_file, args.test_file)
+		print(f"Imported {counts['tests']} tests and {counts['imported']} records ({counts['duplicates']} duplicate "
+		      f"patient/test pairs skipped, {counts['invalid']} invalid)")
+	try:
+		asyncio.run(serve(system, args.host, args.port, args.threads))
+	except KeyboardInterrupt:
+		print("----End of the Medical Test Management System service.")
+
+
+if __name__ == "__main__":
+	main()
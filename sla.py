@@ -0,0 +1,217 @@
+import argparse
+import bisect
+import collections
+import datetime
+import heapq
+import json
+import os
+import time
+
+from PPPPProject2 import MedicalRecordSystem, PatientRecord
+from storage import RecordFile, atomic_write, tail_checksum
+
+
+class TestSLA:
+	# Turnaround times of one test's completed records, counted per whole second, so breach counts and
+	# percentiles can be recomputed against the current limit in memory bounded by distinct turnarounds
+	def __init__(self):
+		self.turnarounds = collections.Counter()
+		self.completed = 0
+
+	def add(self, seconds):
+		self.turnarounds[seconds] += 1
+		self.completed += 1
+
+	def result(self, limit):
+		values = sorted(self.turnarounds)
+		counts = [self.turnarounds[value] for value in values]
+		cumulative = []
+		total = 0
+		for count in counts:
+			total += count
+			cumulative.append(total)
+
+		def percentile(fraction):
+			if not total:
+				return None
+			return datetime.timedelta(seconds=values[bisect.bisect_left(cumulative, fraction * total)])
+
+		breaches = None
+		if limit is not None:
+			position = bisect.bisect_right(values, limit.total_seconds())
+			breaches = total - (cumulative[position - 1] if position else 0)
+		return {
+			'completed': self.completed,
+			'limit': limit,
+			'breaches': breaches,
+			'breach_rate': breaches / total if breaches is not None and total else None,
+			'p50': percentile(0.5),
+			'p90': percentile(0.9),
+			'p99': percentile(0.99)
+		}
+
+
+class SLAMonitor:
+	# Compares each record's turnaround (result date - test date) with its test's DD-hh-mm limit. Completed
+	# records feed per-test turnaround counts; pending ones go on a heap ordered by deadline, and overdue()
+	# only pops the entries whose deadline has passed. With a plain record file, refresh() reads just the
+	# bytes appended since the checkpoint (same inode, tail unchanged); a rewritten file (update/delete, which
+	# rename a new file into place) or any other storage is rescanned
+	def __init__(self, system, checkpoint=None):
+		self.system = system
+		self.checkpoint = checkpoint
+		self.reset()
+		if checkpoint and os.path.exists(checkpoint):
+			self.load()
+
+	def reset(self):
+		self.tests = collections.defaultdict(TestSLA)
+		self.pending = []
+		self.late = []
+		self.position = None
+
+	def incremental(self):
+		storage = self.system.storage
+		return type(storage) is RecordFile and self.system.journal is None
+
+	def refresh(self):
+		# Returns the number of records read
+		if not self.incremental():
+			self.reset()
+			return self.add_lines(self.system._read_lines())
+
+		path = self.system.storage.path
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			self.reset()
+			return 0
+		start = 0
+		if self.position is not None:
+			inode, offset, checksum = self.position
+			if stat.st_ino == inode and stat.st_size >= offset and tail_checksum(path, offset) == checksum:
+				start = offset
+			else:
+				self.reset()
+		else:
+			self.reset()
+
+		with open(path, 'rb') as file:
+			file.seek(start)
+			lines = []
+			offset = start
+			for raw in file:
+				if not raw.endswith(b"\n"):
+					# A writer is mid-line; pick it up next time
+					break
+				offset += len(raw)
+				lines.append(raw.decode().strip())
+		count = self.add_lines(lines)
+		self.position = (stat.st_ino, offset, tail_checksum(path, offset))
+		if self.checkpoint:
+			self.save()
+		return count
+
+	def add_lines(self, lines):
+		count = 0
+		for line in lines:
+			if not line:
+				continue
+			try:
+				record = PatientRecord.parse(line)
+			except (ValueError, IndexError):
+				print(f"Skipping malformed record: {line}")
+				continue
+			count += 1
+			if record.result_date is not None:
+				self.tests[record.test_name].add(int((record.result_date - record.test_date).total_seconds()))
+				continue
+			definition = self.system.tests.get(record.test_name)
+			if definition is not None and definition.turnaround is not None:
+				heapq.heappush(self.pending, (record.test_date + definition.turnaround, record.patient_id,
+				                              record.test_name, record.test_date))
+		return count
+
+	def overdue(self, now=None):
+		# Pending records past their deadline, oldest deadline first
+		now = now or datetime.datetime.now()
+		while self.pending and self.pending[0][0] <= now:
+			self.late.append(heapq.heappop(self.pending))
+		return self.late
+
+	def report(self):
+		results = {}
+		for name, sla in sorted(self.tests.items()):
+			definition = self.system.tests.get(name)
+			results[name] = sla.result(definition.turnaround if definition else None)
+		return results
+
+	def save(self):
+		state = {
+			'position': self.position,
+			'tests': {name: sorted(sla.turnarounds.items()) for name, sla in self.tests.items()},
+			'pending': [[deadline.isoformat(), patient_id, test_name, test_date.isoformat()]
+			            for deadline, patient_id, test_name, test_date in self.pending + self.late]
+		}
+		atomic_write(self.checkpoint, [json.dumps(state)])
+
+	def load(self):
+		try:
+			with open(self.checkpoint, 'r') as file:
+				state = json.load(file)
+		except ValueError:
+			print(f"Ignoring unreadable SLA checkpoint: {self.checkpoint}")
+			return
+		# Checkpoints from before the inode was kept have two-field positions and are rescanned
+		self.position = tuple(state['position']) if state['position'] and len(state['position']) == 3 else None
+		for name, turnarounds in state['tests'].items():
+			sla = self.tests[name]
+			for seconds, count in turnarounds:
+				sla.turnarounds[seconds] = count
+				sla.completed += count
+		self.pending = [(datetime.datetime.fromisoformat(deadline), patient_id, test_name,
+		                 datetime.datetime.fromisoformat(test_date))
+		                for deadline, patient_id, test_name, test_date in state['pending']]
+		heapq.heapify(self.pending)
+
+
+def print_report(monitor, now=None):
+	print(f"----SLA report at {(now or datetime.datetime.now()):%Y-%m-%d %H:%M:%S}")
+	for name, result in monitor.report().items():
+		if result['limit'] is None:
+			print(f"{name}: {result['completed']} completed, no turnaround time defined")
+			continue
+		print(f"{name}: {result['completed']} completed, {result['breaches']} over {result['limit']} "
+		      f"({result['breach_rate'] * 100:.1f}%), p50 {result['p50']}, p90 {result['p90']}, p99 {result['p99']}")
+	late = monitor.overdue(now)
+	print(f"{len(late)} pending records past their deadline")
+	for deadline, patient_id, test_name, test_date in late:
+		print(f"{patient_id}: {test_name}, tested {test_date:%Y-%m-%d %H:%M:%S}, due {deadline:%Y-%m-%d %H:%M:%S}")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Monitor test turnaround times against their SLA.")
+	parser.add_argument('--test-file', default='medicalTest.txt')
+	parser.add_argument('--record-file', default='medicalRecord.txt')
+	parser.add_argument('--partitioned', action='store_true',
+	                    help="records are kept in per-month partitions (<record file stem>.parts/)")
+	parser.add_argument('--checkpoint', help="where to keep state between runs (default: <record file>.sla)")
+	parser.add_argument('--interval', type=float, default=0, help="refresh every N seconds instead of once")
+	args = parser.parse_args()
+
+	system = MedicalRecordSystem(args.test_file, args.record_file, partitioned=args.partitioned)
+	monitor = SLAMonitor(system, args.checkpoint or args.record_file + '.sla')
+	try:
+		while True:
+			monitor.refresh()
+			print_report(monitor)
+			if not args.interval:
+				break
+			time.sleep(args.interval)
+			system.tests = system.load_tests()
+	except KeyboardInterrupt:
+		print("----End of the SLA monitor.")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,832 @@
+import collections
+import datetime
+import itertools
+import mmap
+import os
+import sqlite3
+import threading
+import zlib
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M')
+TIMESTAMP_CACHE_LIMIT = 100000
+_timestamp_cache = {}
+
+
+def parse_timestamp(date_str):
+	# Record dates repeat a lot, so parsed values are interned; strptime is only the fallback
+	# for input that doesn't have the zero-padded 'YYYY-MM-DD hh:mm[:ss]' layout
+	parsed = _timestamp_cache.get(date_str)
+	if parsed is not None:
+		return parsed
+
+	if (len(date_str) in (16, 19) and date_str[4] == '-' and date_str[7] == '-' and date_str[10] == ' '
+			and date_str[13] == ':' and (len(date_str) == 16 or date_str[16] == ':')):
+		try:
+			parsed = datetime.datetime.fromisoformat(date_str)
+		except ValueError:
+			parsed = None
+
+	if parsed is None:
+		for fmt in TIMESTAMP_FORMATS:
+			try:
+				parsed = datetime.datetime.strptime(date_str, fmt)
+				break
+			except ValueError:
+				continue
+		else:
+			raise ValueError(f"time data {date_str!r} does not match format 'YYYY-MM-DD hh:mm[:ss]'")
+
+	if len(_timestamp_cache) >= TIMESTAMP_CACHE_LIMIT:
+		_timestamp_cache.clear()
+	_timestamp_cache[date_str] = parsed
+	return parsed
+
+
+def format_record_line(patient_id, test_name, test_date, result, unit, status, result_date=None):
+	if result_date:
+		return f"{patient_id}: {test_name}, {test_date}, {result}, {unit}, {status}, {result_date}"
+	return f"{patient_id}: {test_name}, {test_date}, {result}, {unit}, {status}"
+
+
+def record_key(line):
+	patient_id, test_name = line.split(', ', 1)[0].split(': ', 1)
+	return patient_id, test_name
+
+
+def file_signature(path):
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return stat.st_mtime_ns, stat.st_size
+
+
+def tail_checksum(path, size, length=1 << 16):
+	# CRC of the bytes just before size; if it still matches later, the file has at most been appended to
+	with open(path, 'rb') as file:
+		file.seek(max(size - length, 0))
+		return zlib.crc32(file.read(min(size, length)))
+
+
+def record_stamp(path):
+	# (size, mtime, tail CRC) of a file, for sidecars built from it to tell appends from rewrites
+	stat = os.stat(path)
+	return stat.st_size, stat.st_mtime_ns, tail_checksum(path, stat.st_size)
+
+
+def read_record_lines(path, patient_id=None, test_name=None):
+	# Without a patient or test to look for, every line is decoded; otherwise the file is
+	# mmap'ed and only lines containing the '<id>: ' prefix or ': <test>, ' token are decoded
+	if not patient_id and not test_name:
+		with open(path, 'r') as file:
+			for line in file:
+				line = line.strip()
+				if line:
+					yield line
+		return
+
+	with open(path, 'rb') as file:
+		if os.fstat(file.fileno()).st_size == 0:
+			return
+		with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+			yield from matching_lines(mapped, patient_id, test_name)
+
+
+def matching_lines(mapped, patient_id=None, test_name=None, start=0, end=None):
+	# The lines of a mapped record file that start inside [start, end) and contain the '<id>: ' prefix
+	# (or '<id>: <test>, ') or the ': <test>, ' token; nothing else is decoded
+	if patient_id:
+		needle = f"{patient_id}: {test_name}, " if test_name else f"{patient_id}: "
+		at_line_start = True
+	else:
+		needle = f": {test_name}, "
+		at_line_start = False
+	needle = needle.encode()
+	if end is None:
+		end = len(mapped)
+	position = mapped.find(needle, start)
+	while position != -1:
+		line_start = mapped.rfind(b"\n", 0, position) + 1
+		if line_start >= end:
+			break
+		line_end = mapped.find(b"\n", position)
+		if line_end == -1:
+			line_end = len(mapped)
+		if line_start >= start and (not at_line_start or line_start == position):
+			yield mapped[line_start:line_end].decode().strip()
+		position = mapped.find(needle, line_end)
+
+
+class FileLock:
+	# Re-entrant lock on '<path>.lock' (flock between processes, RLock between threads); not on the
+	# data file itself, since rewrites rename a new file over it
+	def __init__(self, path):
+		self.path = path + '.lock'
+		self.thread_lock = threading.RLock()
+		self.depth = 0
+		self.file = None
+
+	def __enter__(self):
+		self.thread_lock.acquire()
+		if self.depth == 0 and fcntl is not None:
+			try:
+				self.file = open(self.path, 'a')
+				fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+			except BaseException:
+				if self.file is not None:
+					self.file.close()
+					self.file = None
+				self.thread_lock.release()
+				raise
+		self.depth += 1
+		return self
+
+	def __exit__(self, *exc_info):
+		self.depth -= 1
+		if self.depth == 0 and self.file is not None:
+			fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+			self.file.close()
+			self.file = None
+		self.thread_lock.release()
+
+
+def append_lines(path, lines, sync=False):
+	with open(path, 'a', buffering=1 << 20) as file:
+		file.writelines(line + "\n" for line in lines)
+		if sync:
+			file.flush()
+			os.fsync(file.fileno())
+
+
+def atomic_write(path, lines, binary=False):
+	# Writes a uniquely named temp file next to path, fsyncs it and renames it over path, so a reader
+	# or a crash only ever sees the old or the new contents. With binary, lines are bytes written as is
+	temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+	try:
+		with open(temp_path, 'wb' if binary else 'w') as file:
+			file.writelines(lines if binary else (line + "\n" for line in lines))
+			file.flush()
+			os.fsync(file.fileno())
+		if os.path.exists(path):
+			os.chmod(temp_path, os.stat(path).st_mode & 0o777)
+		os.replace(temp_path, path)
+	except BaseException:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+		raise
+
+
+class OffsetIndexFile:
+	# Header, then fixed-width (NUL-padded key, 8-byte offset) entries sorted for a binary search over an
+	# mmap, then a tail of 'key\toffset' lines appended since
+	HEADER = "{:020d} {:020d} {:010d} {:04d} {:012d}\n"
+	HEADER_SIZE = 71
+
+	def __init__(self, path):
+		self.path = path
+		self.stamp = None
+		self.block = (None, 0, 0)
+		self.tail = {}
+
+	@classmethod
+	def read_header(cls, file):
+		size, mtime, checksum, width, count = map(int, file.read(cls.HEADER_SIZE).decode().split())
+		return (size, mtime, checksum), width, count
+
+	def load(self):
+		# Returns the stamp the file was written for, or None if it is missing or unreadable
+		self.stamp = None
+		try:
+			with open(self.path, 'rb') as file:
+				stamp, width, count = self.read_header(file)
+				block_end = self.HEADER_SIZE + count * (width + 8)
+				if os.fstat(file.fileno()).st_size < block_end:
+					return None
+				file.seek(block_end)
+				tail = collections.defaultdict(list)
+				for raw in file:
+					key, offset = raw.rstrip(b"\n").rsplit(b"\t", 1)
+					offset = int(offset)
+					if offset < stamp[0]:
+						tail[key.decode()].append(offset)
+				mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if count else None
+		except (FileNotFoundError, ValueError):
+			return None
+		# Readers may still hold the previous block, so it is replaced rather than closed
+		self.block = (mapped, width, count)
+		self.tail = tail
+		self.stamp = stamp
+		return stamp
+
+	def write(self, entries, stamp):
+		# entries are (key, offset) pairs sorted by key and offset
+		width = max((len(key.encode()) for key, offset in entries), default=0)
+		header = self.HEADER.format(*stamp, width, len(entries)).encode()
+		atomic_write(self.path, itertools.chain([header], (key.encode().ljust(width, b"\0") + offset.to_bytes(8, 'little')
+		                                                     for key, offset in entries)), binary=True)
+		self.load()
+
+	def append(self, entries, stamp):
+		mapped, width, count = self.block
+		with open(self.path, 'r+b') as file:
+			file.seek(0, os.SEEK_END)
+			file.writelines(f"{key}\t{offset}\n".encode() for key, offset in entries)
+			file.seek(0)
+			file.write(self.HEADER.format(*stamp, width, count).encode())
+		for key, offset in entries:
+			self.tail.setdefault(key, []).append(offset)
+		self.stamp = stamp
+
+	def tail_size(self):
+		return sum(len(offsets) for offsets in self.tail.values())
+
+	def lookup(self, key):
+		# The key's offsets in ascending order: the sorted block's, then the tail's, which come after them
+		mapped, width, count = self.block
+		offsets = []
+		target = key.encode()
+		if count and len(target) <= width:
+			target = target.ljust(width, b"\0")
+			size = width + 8
+			low, high = 0, count
+			while low < high:
+				middle = (low + high) // 2
+				position = self.HEADER_SIZE + middle * size
+				if mapped[position:position + width] < target:
+					low = middle + 1
+				else:
+					high = middle
+			position = self.HEADER_SIZE + low * size
+			while low < count and mapped[position:position + width] == target:
+				offsets.append(int.from_bytes(mapped[position + width:position + size], 'little'))
+				low += 1
+				position += size
+		offsets.extend(self.tail.get(key, ()))
+		return offsets
+
+
+class RecordIndex:
+	# Patient ID and test name -> line offsets in '<record file>.patients.idx' and '.tests.idx', stamped
+	# with the record file; appends are indexed incrementally, anything else rebuilds both
+	TAIL_LIMIT = 100000
+
+	def __init__(self, path):
+		self.path = path
+		self.files = {'patient': OffsetIndexFile(path + '.patients.idx'), 'test': OffsetIndexFile(path + '.tests.idx')}
+		self.stamp = None
+		self.load()
+
+	def read_stamp(self):
+		try:
+			with open(self.files['patient'].path, 'rb') as file:
+				return OffsetIndexFile.read_header(file)[0]
+		except (FileNotFoundError, ValueError):
+			return None
+
+	def load(self):
+		self.stamp = None
+		stamps = [index.load() for index in self.files.values()]
+		if stamps[0] is not None and stamps[0] == stamps[1]:
+			self.stamp = stamps[0]
+
+	def refresh(self):
+		# Brings the index up to date with the record file; returns False if there is no record file
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return False
+		current = (stat.st_size, stat.st_mtime_ns)
+		if (self.stamp is None or current != self.stamp[:2]) and self.read_stamp() != self.stamp:
+			# Another process indexed the file since we last looked
+			self.load()
+		if self.stamp is not None:
+			size, mtime, checksum = self.stamp
+			if current == (size, mtime):
+				return True
+			if stat.st_size >= size and tail_checksum(self.path, size) == checksum:
+				self.index_from(size)
+				return True
+		self.rebuild()
+		return True
+
+	def scan(self, start):
+		# Yields (offset, patient_id, test_name) for each line starting at or after start
+		with open(self.path, 'rb') as file:
+			file.seek(start)
+			offset = start
+			for raw in file:
+				fields = raw.split(b', ', 1)[0].split(b': ', 1)
+				if len(fields) == 2:
+					yield offset, fields[0].strip().decode(), fields[1].decode()
+				offset += len(raw)
+
+	def index_from(self, start):
+		entries = list(self.scan(start))
+		if self.files['patient'].tail_size() + len(entries) > self.TAIL_LIMIT:
+			self.rebuild()
+			return
+		stamp = record_stamp(self.path)
+		self.files['patient'].append([(patient_id, offset) for offset, patient_id, test_name in entries], stamp)
+		self.files['test'].append([(test_name, offset) for offset, patient_id, test_name in entries], stamp)
+		self.stamp = stamp
+
+	def rebuild(self):
+		self.stamp = None
+		patients, tests = [], []
+		for offset, patient_id, test_name in self.scan(0):
+			patients.append((patient_id, offset))
+			tests.append((test_name, offset))
+		patients.sort()
+		tests.sort()
+		stamp = record_stamp(self.path)
+		self.files['patient'].write(patients, stamp)
+		self.files['test'].write(tests, stamp)
+		self.stamp = stamp
+
+	def candidates(self, patient_id=None, test_name=None):
+		# With both, the patient's offsets are used and their lines filtered on the test as they are read
+		if patient_id:
+			return self.files['patient'].lookup(patient_id)
+		return self.files['test'].lookup(test_name)
+
+	def read_lines(self, patient_id=None, test_name=None):
+		# The indexed lines for a patient and/or test, read without the record lock; None unless the record
+		# file as opened is the one the index was stamped with. The stamp is taken before the offsets, and
+		# refresh() only sets it once the offsets are in, so the offsets always cover the stamped file
+		stamp = self.stamp
+		if stamp is None:
+			return None
+		offsets = self.candidates(patient_id, test_name)
+		try:
+			file = open(self.path, 'rb')
+		except FileNotFoundError:
+			return None
+		lines = []
+		with file:
+			stat = os.fstat(file.fileno())
+			if (stat.st_size, stat.st_mtime_ns) != stamp[:2]:
+				return None
+			for offset in offsets:
+				file.seek(offset)
+				line = file.readline().decode().strip()
+				key = record_key(line) if ': ' in line else (None, None)
+				if key[0] is None or (patient_id and key[0] != patient_id) or \
+						(not patient_id and key[1] != test_name):
+					return None
+				if test_name and key[1] != test_name:
+					continue
+				lines.append(line)
+		return lines
+
+
+class RecordFile:
+	# The plain single-file layout of medicalRecord.txt. Writers hold the file lock, so appends from
+	# other processes can't land between a rewrite's read and its rename
+	def __init__(self, path, indexed=False):
+		self.path = path
+		self.lock = FileLock(path)
+		self.sync = False
+		self.index = RecordIndex(path) if indexed else None
+
+	def read_lines(self, start_date=None, end_date=None, patient_id=None, test_name=None):
+		if self.index is not None and (patient_id or test_name):
+			return self.read_indexed(patient_id, test_name)
+		return read_record_lines(self.path, patient_id, test_name)
+
+	def read_indexed(self, patient_id, test_name):
+		# The lock is only held to bring the index up to date; a file that keeps changing under the read
+		# is scanned instead
+		for attempt in range(3):
+			lines = self.index.read_lines(patient_id, test_name)
+			if lines is not None:
+				yield from lines
+				return
+			with self.lock:
+				if not self.index.refresh():
+					return
+		yield from read_record_lines(self.path, patient_id, test_name)
+
+	def signature(self):
+		return file_signature(self.path)
+
+	def append(self, line):
+		self.append_many([line])
+
+	def append_many(self, lines):
+		with self.lock:
+			append_lines(self.path, lines, self.sync)
+			if self.index is not None:
+				self.index.refresh()
+
+	def rewrite(self, lines):
+		with self.lock:
+			atomic_write(self.path, lines)
+			if self.index is not None:
+				self.index.refresh()
+
+	def replace(self, patient_id, test_name, new_line):
+		# Replaces (or drops, when new_line is None) every line for the patient/test pair
+		prefix = f"{patient_id}: {test_name},"
+		with self.lock:
+			if not any(line.startswith(prefix) for line in self.read_lines(patient_id=patient_id, test_name=test_name)):
+				return False
+			self.rewrite(line if not line.startswith(prefix) else new_line
+			             for line in self.read_lines()
+			             if new_line is not None or not line.startswith(prefix))
+		return True
+
+
+class PartitionedRecordFile(RecordFile):
+	# The record file plus a copy of its lines split by test month ('<stem>.parts/YYYY-MM.txt'), so a
+	# date-range read only opens the months it overlaps
+	def __init__(self, path, indexed=False):
+		super().__init__(path, indexed)
+		self.directory = os.path.splitext(path)[0] + '.parts'
+		self.stamp_path = os.path.join(self.directory, 'stamp')
+		with self.lock:
+			self.refresh()
+
+	@staticmethod
+	def partition_of(line):
+		return parse_timestamp(line.split(', ', 2)[1]).strftime('%Y-%m')
+
+	def partition_path(self, month):
+		return os.path.join(self.directory, month + '.txt')
+
+	def partitions(self, start_date=None, end_date=None):
+		first = start_date.strftime('%Y-%m') if start_date else None
+		last = end_date.strftime('%Y-%m') if end_date else None
+		for name in sorted(os.listdir(self.directory)):
+			if not name.endswith('.txt'):
+				continue
+			month = name[:-4]
+			if (first and month < first) or (last and month > last):
+				continue
+			yield os.path.join(self.directory, name)
+
+	def read_stamp(self):
+		try:
+			with open(self.stamp_path, 'r') as file:
+				return tuple(map(int, file.read().split()))
+		except (FileNotFoundError, ValueError):
+			return None
+
+	def write_stamp(self):
+		atomic_write(self.stamp_path, ["{} {} {}".format(*record_stamp(self.path))])
+
+	def refresh(self):
+		# Brings the partitions up to date with the record file; returns False if there is no record file
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return False
+		stamp = self.read_stamp()
+		if stamp is not None and len(stamp) == 3:
+			size, mtime, checksum = stamp
+			if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+				return True
+			if stat.st_size >= size and tail_checksum(self.path, size) == checksum:
+				self.copy_appended(size)
+				return True
+		self.cut(read_record_lines(self.path))
+		return True
+
+	def copy_appended(self, start):
+		months = {}
+		with open(self.path, 'r') as file:
+			file.seek(start)
+			for line in file:
+				line = line.strip()
+				if line:
+					months.setdefault(self.partition_of(line), []).append(line)
+		for month, month_lines in months.items():
+			append_lines(self.partition_path(month), month_lines)
+		self.write_stamp()
+
+	def cut(self, lines, months=None):
+		# Writes lines into new partition files that replace the old ones: all of them, or with months only
+		# those months (lines then only come from those months)
+		os.makedirs(self.directory, exist_ok=True)
+		temp_files = {}
+		try:
+			for line in lines:
+				month = self.partition_of(line)
+				if month not in temp_files:
+					temp_files[month] = open(self.partition_path(month) + '.tmp', 'w')
+				temp_files[month].write(line + "\n")
+			for file in temp_files.values():
+				file.flush()
+				os.fsync(file.fileno())
+		finally:
+			for file in temp_files.values():
+				file.close()
+		for partition in list(self.partitions()):
+			month = os.path.basename(partition)[:-4]
+			if month not in temp_files and (months is None or month in months):
+				os.remove(partition)
+		for month in temp_files:
+			os.replace(self.partition_path(month) + '.tmp', self.partition_path(month))
+		self.write_stamp()
+
+	def read_lines(self, start_date=None, end_date=None, patient_id=None, test_name=None):
+		if not (start_date or end_date):
+			return super().read_lines(start_date, end_date, patient_id, test_name)
+		return self.read_partitions(start_date, end_date, patient_id, test_name)
+
+	def read_partitions(self, start_date, end_date, patient_id, test_name):
+		with self.lock:
+			if not self.refresh():
+				return
+			partitions = list(self.partitions(start_date, end_date))
+		for partition in partitions:
+			try:
+				yield from read_record_lines(partition, patient_id, test_name)
+			except FileNotFoundError:
+				# Its month was emptied by a rewrite since
+				continue
+
+	def append_many(self, lines):
+		# Stamped before and after, so the second refresh only copies these lines
+		with self.lock:
+			self.refresh()
+			append_lines(self.path, lines, self.sync)
+			self.refresh()
+			if self.index is not None:
+				self.index.refresh()
+
+	def rewrite(self, lines):
+		with self.lock:
+			atomic_write(self.path, lines)
+			self.cut(read_record_lines(self.path))
+			if self.index is not None:
+				self.index.refresh()
+
+	def replace(self, patient_id, test_name, new_line):
+		# The record file is rewritten as a whole, but only the partitions of the months that held the
+		# patient/test pair (and the month it moves to) are re-cut
+		prefix = f"{patient_id}: {test_name},"
+		with self.lock:
+			if not self.refresh():
+				return False
+			months = {self.partition_of(line) for line in read_record_lines(self.path, patient_id, test_name)
+			          if line.startswith(prefix)}
+			if not months:
+				return False
+			if new_line is not None:
+				months.add(self.partition_of(new_line))
+			atomic_write(self.path, (line if not line.startswith(prefix) else new_line
+			                         for line in read_record_lines(self.path)
+			                         if new_line is not None or not line.startswith(prefix)))
+			self.cut((line for line in read_record_lines(self.path) if self.partition_of(line) in months), months)
+			if self.index is not None:
+				self.index.refresh()
+		return True
+
+
+class SQLiteRecordStorage:
+	# Records and the test catalogue in an embedded SQLite database; filters and summaries
+	# are pushed down into indexed SQL instead of scanning text
+	SCHEMA = """
+		CREATE TABLE IF NOT EXISTS tests (
+			name TEXT PRIMARY KEY, range TEXT, unit TEXT, turnaround_time TEXT
+		);
+		CREATE TABLE IF NOT EXISTS records (
+			id INTEGER PRIMARY KEY, patient_id TEXT NOT NULL, test_name TEXT NOT NULL, test_date TEXT NOT NULL,
+			result REAL NOT NULL, result_text TEXT NOT NULL, unit TEXT, status TEXT, result_date TEXT
+		);
+		CREATE INDEX IF NOT EXISTS records_patient ON records (patient_id, test_name);
+		CREATE INDEX IF NOT EXISTS records_test ON records (test_name);
+		CREATE INDEX IF NOT EXISTS records_date ON records (test_date);
+		CREATE INDEX IF NOT EXISTS records_status ON records (lower(status));
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = FileLock(path)
+		self.sync = False
+		self.local = threading.local()
+		with self.connection() as connection:
+			connection.execute("PRAGMA journal_mode=WAL")
+			connection.executescript(self.SCHEMA)
+
+	def connection(self):
+		# One connection per thread; WAL lets readers run alongside a writer
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			connection = sqlite3.connect(self.path)
+			self.local.connection = connection
+		return connection
+
+	@staticmethod
+	def to_row(line):
+		parts = line.split(', ')
+		patient_id, test_name = parts[0].split(': ', 1)
+		result_date = parse_timestamp(parts[5]).strftime('%Y-%m-%d %H:%M:%S') if len(parts) > 5 else None
+		return (patient_id, test_name, parse_timestamp(parts[1]).strftime('%Y-%m-%d %H:%M:%S'), float(parts[2]),
+		        parts[2], parts[3], parts[4], result_date)
+
+	@staticmethod
+	def where(patient_id=None, test_name=None, start_date=None, end_date=None, status=None):
+		clauses, params = [], []
+		if patient_id:
+			clauses.append("patient_id = ?")
+			params.append(patient_id)
+		if test_name:
+			clauses.append("test_name = ?")
+			params.append(test_name)
+		if start_date:
+			clauses.append("test_date >= ?")
+			params.append(start_date.strftime('%Y-%m-%d %H:%M:%S'))
+		if end_date:
+			clauses.append("test_date <= ?")
+			params.append(end_date.strftime('%Y-%m-%d %H:%M:%S'))
+		if status:
+			clauses.append("lower(status) = ?")
+			params.append(status.lower())
+		return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+	def query(self, patient_id=None, test_name=None, start_date=None, end_date=None, status=None):
+		where, params = self.where(patient_id, test_name, start_date, end_date, status)
+		cursor = self.connection().execute(
+			"SELECT patient_id, test_name, test_date, result_text, unit, status, result_date FROM records"
+			+ where + " ORDER BY id", params)
+		for row in cursor:
+			yield format_record_line(*row)
+
+	def read_lines(self, start_date=None, end_date=None, patient_id=None, test_name=None):
+		return self.query(patient_id, test_name, start_date, end_date)
+
+	def signature(self):
+		return file_signature(self.path), file_signature(self.path + '-wal')
+
+	def summary(self, patient_id=None, test_name=None, start_date=None, end_date=None, status=None):
+		where, params = self.where(patient_id, test_name, start_date, end_date, status)
+		where = (where + " AND" if where else " WHERE") + " result_date IS NOT NULL"
+		row = self.connection().execute(
+			"SELECT COUNT(*), MIN(result), MAX(result), AVG(result), MIN(ta), MAX(ta), AVG(ta) FROM ("
+			"SELECT result, strftime('%s', result_date) - strftime('%s', test_date) AS ta FROM records"
+			+ where + ")", params).fetchone()
+		if not row[0]:
+			return {'min_val': None, 'max_val': None, 'avg_val': None, 'min_ta': None, 'max_ta': None, 'avg_ta': None}
+		return {
+			'min_val': row[1],
+			'max_val': row[2],
+			'avg_val': row[3],
+			'min_ta': datetime.timedelta(seconds=row[4]),
+			'max_ta': datetime.timedelta(seconds=row[5]),
+			'avg_ta': datetime.timedelta(seconds=row[6])
+		}
+
+	def append(self, line):
+		self.append_many([line])
+
+	def append_many(self, lines):
+		with self.connection() as connection:
+			connection.executemany(
+				"INSERT INTO records (patient_id, test_name, test_date, result, result_text, unit, status, result_date)"
+				" VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (self.to_row(line) for line in lines))
+
+	def rewrite(self, lines):
+		rows = [self.to_row(line) for line in lines]
+		with self.connection() as connection:
+			connection.execute("DELETE FROM records")
+			connection.executemany(
+				"INSERT INTO records (patient_id, test_name, test_date, result, result_text, unit, status, result_date)"
+				" VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+	def replace(self, patient_id, test_name, new_line):
+		with self.connection() as connection:
+			if new_line is None:
+				cursor = connection.execute("DELETE FROM records WHERE patient_id = ? AND test_name = ?",
+				                            (patient_id, test_name))
+			else:
+				cursor = connection.execute(
+					"UPDATE records SET test_date = ?, result = ?, result_text = ?, unit = ?, status = ?, result_date = ?"
+					" WHERE patient_id = ? AND test_name = ?", self.to_row(new_line)[2:] + (patient_id, test_name))
+		return cursor.rowcount > 0
+
+	def read_test_lines(self):
+		for row in self.connection().execute("SELECT name, range, unit, turnaround_time FROM tests ORDER BY rowid"):
+			yield ';'.join(row)
+
+	def save_test(self, test_name, range_str, unit, turnaround_time):
+		with self.connection() as connection:
+			connection.execute("INSERT OR REPLACE INTO tests VALUES (?, ?, ?, ?)",
+			                   (test_name, range_str, unit, turnaround_time))
+
+	def remove_test(self, test_name):
+		with self.connection() as connection:
+			connection.execute("DELETE FROM tests WHERE name = ?", (test_name,))
+
+
+class RecordJournal:
+	# Update/delete/append entries written next to the record file instead of rewriting it; readers
+	# replay them until compact() folds them back in, which a background thread does past limit entries
+	def __init__(self, storage, limit=10000):
+		self.storage = storage
+		self.path = storage.path + '.journal'
+		self.lock = storage.lock
+		self.limit = limit
+		self.replay_lock = threading.Lock()
+		self.compactor = None
+		self.reset()
+
+	def reset(self):
+		self.stamp = None
+		self.overrides = {}
+		self.appended = {}
+		self.entries = 0
+
+	def append(self, *fields):
+		self.append_many([fields])
+
+	def append_many(self, entries):
+		with self.lock:
+			append_lines(self.path, ['\t'.join(fields) for fields in entries], self.storage.sync)
+			self.replay()
+			if self.entries >= self.limit and (self.compactor is None or not self.compactor.is_alive()):
+				self.compactor = threading.Thread(target=self.compact)
+				self.compactor.start()
+
+	def replay(self):
+		# Returns (overrides, appended lines) as on disk now: overrides maps a patient/test key to its
+		# replacement line (None when deleted) for lines in the base file
+		with self.replay_lock:
+			self.refresh()
+			return dict(self.overrides), [line for lines in self.appended.values() for line in lines]
+
+	def refresh(self):
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			self.reset()
+			return
+		start = 0
+		if self.stamp is not None:
+			inode, size, mtime, checksum = self.stamp
+			if (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (inode, size, mtime):
+				return
+			if stat.st_ino == inode and stat.st_size >= size and tail_checksum(self.path, size) == checksum:
+				start = size
+		if not start:
+			self.reset()
+		offset = start
+		try:
+			with open(self.path, 'rb') as file:
+				file.seek(start)
+				for raw in file:
+					if not raw.endswith(b"\n"):
+						# A writer is mid-entry; it is picked up on the next replay
+						break
+					offset += len(raw)
+					self.apply(raw.decode().rstrip('\r\n').split('\t'))
+		except FileNotFoundError:
+			self.reset()
+			return
+		self.stamp = (stat.st_ino, offset, stat.st_mtime_ns, tail_checksum(self.path, offset))
+
+	def apply(self, fields):
+		self.entries += 1
+		if fields[0] == 'A':
+			self.appended.setdefault(record_key(fields[1]), []).append(fields[1])
+		elif fields[0] == 'U':
+			key = (fields[1], fields[2])
+			self.overrides[key] = fields[3]
+			if key in self.appended:
+				self.appended[key] = [fields[3]] * len(self.appended[key])
+		elif fields[0] == 'D':
+			key = (fields[1], fields[2])
+			self.overrides[key] = None
+			self.appended.pop(key, None)
+
+	def read_lines(self, start_date=None, end_date=None, patient_id=None, test_name=None):
+		# Overrides keep the patient/test key, so the storage prefilter still applies to them, but not the test
+		# date the storage prunes on: with any override the base lines are read for every date, and callers
+		# filter on the replayed dates
+		overrides, appended = self.replay()
+		if overrides:
+			start_date = end_date = None
+		for line in self.storage.read_lines(start_date, end_date, patient_id, test_name):
+			if overrides:
+				key = record_key(line)
+				if key in overrides:
+					line = overrides[key]
+					if line is None:
+						continue
+			yield line
+		yield from appended
+
+	def compact(self):
+		# Always folds in what is on disk, including entries other processes wrote. The replayed lines are
+		# streamed into the rewrite, which only replaces the base file once they are all written
+		with self.lock:
+			self.storage.rewrite(self.read_lines())
+			if os.path.exists(self.path):
+				os.remove(self.path)
+			with self.replay_lock:
+				self.reset()
@@ -0,0 +1,75 @@
+import pytest
+
+from analytics import DeltaThreshold, SeriesState, TrendAnalyzer, parse_thresholds
+from conftest import UPDATE
+from PPPPProject2 import MedicalRecordSystem, PatientRecord
+
+
+def record(result, test_date='2024-01-01 08:00:00', patient_id='7654321'):
+	return PatientRecord.parse(f"{patient_id}: LDL, {test_date}, {result}, mg/dL, Completed")
+
+
+def test_delta_thresholds_are_absolute_or_relative():
+	absolute = DeltaThreshold('30')
+	assert absolute.exceeded(100, 131) and absolute.exceeded(100, 69)
+	assert not absolute.exceeded(100, 130) and not absolute.exceeded(0, 30)
+	relative = DeltaThreshold(' 25% ')
+	assert relative.exceeded(100, 126) and relative.exceeded(-100, -130)
+	assert not relative.exceeded(100, 125) and not relative.exceeded(-100, -75)
+	# Any change from 0 is an infinite relative change
+	assert relative.exceeded(0, 0.1) and relative.exceeded(0, -0.1) and not relative.exceeded(0, 0)
+	assert (str(absolute), str(relative), str(DeltaThreshold('2.5%'))) == ('30', '25%', '2.5%')
+	with pytest.raises(ValueError):
+		DeltaThreshold('-5')
+	assert {name: str(limit) for name, limit in parse_thresholds(['LDL=30', 'A=B=10%']).items()} == \
+		{'LDL': '30', 'A=B': '10%'}
+	for value in ('LDL', '=30', 'LDL=high'):
+		with pytest.raises(ValueError):
+			parse_thresholds([value])
+
+
+def test_slope_needs_two_distinct_test_dates():
+	state = SeriesState(record(100))
+	assert state.slope() is None
+	state.add(record(100))
+	assert state.slope() is None
+	state.add(record(110))
+	assert state.count == 2 and state.slope() is None
+	state.add(record(130, '2024-01-11 08:00:00'))
+	assert state.slope() == pytest.approx(2.5)
+	state.remove(record(130, '2024-01-11 08:00:00'))
+	assert state.slope() is None and state.last_value == 130
+
+
+def test_out_of_order_results_count_towards_the_slope_only(files):
+	test_file, record_file = files
+	analyzer = TrendAnalyzer(MedicalRecordSystem(test_file, record_file), {'LDL': '10'})
+	assert analyzer.observe(record(100, '2024-01-10 08:00:00')) is None
+	assert analyzer.observe(record(120, '2023-12-31 08:00:00')) is None
+	assert analyzer.out_of_order == 1 and not analyzer.violations
+	violation = analyzer.observe(record(80, '2024-01-20 08:00:00'))
+	assert violation['previous'] == 100 and violation['change'] == -20 and violation['threshold'] == '10'
+	row = analyzer.trends(test_name='LDL')[0]
+	assert row['count'] == 3 and row['last_value'] == 80
+	assert row['slope_per_day'] == pytest.approx(-2.0)
+
+
+def test_listener_corrects_same_date_updates_and_checks_new_results(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file)
+	seen = []
+	analyzer = TrendAnalyzer(system, {'BGT': DeltaThreshold('10')}, on_violation=seen.append)
+	assert analyzer.prime() == 20
+	analyzer.attach()
+
+	system.update_patient_record('1000001', 'BGT', dict(UPDATE, test_date='2024-01-01 08:00:00', result='95'))
+	row = analyzer.trends('1000001')[0]
+	assert row['count'] == 1 and row['last_value'] == 95 and not seen
+
+	system.update_patient_record('1000001', 'BGT', UPDATE)
+	assert len(seen) == 1 and seen[0]['previous'] == 95 and seen[0]['result'] == 120
+	row = analyzer.trends('1000001', 'BGT')[0]
+	assert row['count'] == 2 and row['slope_per_day'] == pytest.approx(25 / 31)
+
+	system.add_patient_record('7654321', 'BGT', '2024-01-05 08:00:00', '80', 'mg/dL', 'Pending')
+	assert len(analyzer.series) == 21 and list(analyzer.violations) == seen
@@ -0,0 +1,126 @@
+import asyncio
+import json
+
+from PPPPProject2 import MedicalRecordSystem
+from service import MedicalRecordService, ReadWriteLock
+
+RECORD = {'patient_id': '7654321', 'test_name': 'LDL', 'test_date': '2024-02-03 09:30:00', 'result': 0,
+          'unit': 'mg/dL', 'status': 'Completed', 'result_date': '2024-02-03 11:30:00'}
+
+
+def handle_all(system, requests):
+	async def run():
+		service = MedicalRecordService(system, threads=2)
+		return [await service.handle(request) for request in requests]
+	return asyncio.run(run())
+
+
+def test_service_handles_every_op(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file)
+	responses = handle_all(system, [
+		dict(RECORD, op='add'),
+		dict(RECORD, op='add'),
+		dict(RECORD, op='update', result=150.5, status='Reviewed'),
+		dict(RECORD, op='update', patient_id='7654322'),
+		{'op': 'filter', 'patient_id': '7654321'},
+		{'op': 'filter', 'test_name': 'BGT', 'start_date': '2024-01-01', 'end_date': '2024-01-01 09:00'},
+		{'op': 'summary', 'test_name': 'LDL'},
+		{'op': 'delete', 'patient_id': '7654321', 'test_name': 'LDL'},
+		{'op': 'delete', 'patient_id': '7654321', 'test_name': 'LDL'},
+		{'op': 'stats'},
+	])
+	assert responses[0] == {'ok': True}
+	assert responses[1] == {'ok': False, 'error': "Record exists. Use the update op to change it."}
+	assert responses[2] == {'ok': True}
+	assert responses[3] == {'ok': False, 'error': "No record found for Patient ID: 7654322 and Test Name: LDL."}
+	assert responses[4] == {'ok': True, 'records': [
+		"7654321: LDL, 2024-02-03 09:30:00, 150.5, mg/dL, Reviewed, 2024-02-03 11:30:00"]}
+	assert len(responses[5]['records']) == 20
+	assert responses[6] == {'ok': True, 'summary': {'min_val': 150.5, 'max_val': 150.5, 'avg_val': 150.5,
+	                                                'min_ta': 7200.0, 'max_ta': 7200.0, 'avg_ta': 7200.0}}
+	assert responses[7] == {'ok': True} and responses[8] == {'ok': False}
+	assert responses[9] == {'ok': False, 'error': "Instrumentation is off; start the service with --stats."}
+
+	stats = handle_all(MedicalRecordSystem(test_file, record_file, instrument=True), [{'op': 'stats'}])[0]
+	assert stats['ok'] and isinstance(stats['stats'], dict)
+
+
+def test_service_keeps_a_zero_result(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file)
+	assert handle_all(system, [dict(RECORD, op='add')]) == [{'ok': True}]
+	assert str(system.filter_tests(patient_id='7654321')[0]) == \
+		"7654321: LDL, 2024-02-03 09:30:00, 0, mg/dL, Completed, 2024-02-03 11:30:00"
+	assert handle_all(system, [dict(RECORD, op='update', result_date=None, status='Pending')]) == [{'ok': True}]
+	assert str(system.filter_tests(patient_id='7654321')[0]) == "7654321: LDL, 2024-02-03 09:30:00, 0, mg/dL, Pending"
+
+
+def test_service_rejects_invalid_requests(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file)
+	responses = handle_all(system, [
+		dict(RECORD, op='add', test_date='2024-02-30 09:30'),
+		dict(RECORD, op='add', test_name='XYZ'),
+		dict(RECORD, op='update', result='high'),
+		{'op': 'drop'},
+		['add'],
+	])
+	assert all(not response['ok'] for response in responses)
+	assert responses[3] == {'ok': False, 'error': "Unknown op: drop"}
+	assert responses[4] == {'ok': False, 'error': "Expected a JSON object"}
+	assert len(system.filter_tests()) == 20
+
+
+def test_service_answers_each_line_of_a_connection(files):
+	test_file, record_file = files
+	service = MedicalRecordService(MedicalRecordSystem(test_file, record_file), threads=2)
+
+	async def run():
+		server = await asyncio.start_server(service.serve_client, '127.0.0.1', 0)
+		async with server:
+			reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+			writer.write(b'{"op": "filter", "patient_id": "1000001"\n\n{"op": "filter", "start_date": "yesterday"}\n'
+			             b'{"op": "filter", "patient_id": "1000001"}\n')
+			await writer.drain()
+			responses = [json.loads(await reader.readline()) for _ in range(3)]
+			writer.close()
+			await writer.wait_closed()
+			return responses
+
+	malformed, bad_date, found = asyncio.run(run())
+	assert not malformed['ok'] and not bad_date['ok']
+	assert found == {'ok': True, 'records': [
+		"1000001: BGT, 2024-01-01 08:00:00, 80, mg/dL, Completed, 2024-01-01 10:00:00"]}
+
+
+def test_read_write_lock_shares_reads_and_queues_new_readers_behind_a_writer():
+	async def run():
+		lock = ReadWriteLock()
+		events = []
+
+		async def read(name, hold):
+			async with lock.read():
+				events.append(name + ' in')
+				await asyncio.sleep(hold)
+				events.append(name + ' out')
+
+		async def write():
+			async with lock.write():
+				events.append('writer in')
+				await asyncio.sleep(0.01)
+				events.append('writer out')
+
+		first = asyncio.create_task(read('a', 0.05))
+		second = asyncio.create_task(read('b', 0.05))
+		await asyncio.sleep(0.01)
+		writer = asyncio.create_task(write())
+		await asyncio.sleep(0.01)
+		late = asyncio.create_task(read('c', 0))
+		await asyncio.gather(first, second, writer, late)
+		return events
+
+	events = asyncio.run(run())
+	assert events[:2] == ['a in', 'b in']
+	assert events.index('writer in') > max(events.index('a out'), events.index('b out'))
+	assert events[-2:] == ['c in', 'c out'] and events.index('writer out') < events.index('c in')
@@ -0,0 +1,22 @@
+from conftest import record_line
+from PPPPProject2 import MedicalRecordSystem
+from sla import SLAMonitor
+
+
+def test_same_length_rewrite_outside_the_tail_is_rescanned(files, tmp_path):
+	test_file, record_file = files
+	with open(record_file, 'w') as file:
+		file.writelines(record_line(number) + "\n" for number in range(3000))
+	system = MedicalRecordSystem(test_file, record_file)
+	checkpoint = str(tmp_path / 'medicalRecord.txt.sla')
+	monitor = SLAMonitor(system, checkpoint)
+	monitor.refresh()
+	assert monitor.report()['BGT']['breaches'] == 0
+
+	system.update_patient_record('1000001', 'BGT', {'test_date': '2024-01-01 08:00:00', 'result': '80',
+	                                                'unit': 'mg/dL', 'status': 'Completed',
+	                                                'result_date': '2024-01-09 10:00:00'})
+	monitor.refresh()
+	assert monitor.report()['BGT']['breaches'] == 1
+	assert SLAMonitor(system, checkpoint).report()['BGT']['breaches'] == 1
+	assert SLAMonitor(system).refresh() == 3000
@@ -0,0 +1,326 @@
+import datetime
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import PPPPProject2
+from conftest import CRITERIA, UPDATE, lines_of, mixed_records, record_line
+from PPPPProject2 import MedicalRecordSystem
+from storage import RecordFile, RecordIndex
+
+
+def append_records(record_file, first, count):
+	storage = RecordFile(record_file)
+	for number in range(first, first + count):
+		storage.append(record_line(number, 'LDL'))
+
+
+def journal_update(test_file, record_file, patient_id):
+	system = MedicalRecordSystem(test_file, record_file, journal=True)
+	system.update_patient_record(patient_id, 'BGT', UPDATE)
+	system.add_patient_record('7654321', 'LDL', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+
+
+def run_process(target, *args):
+	process = multiprocessing.Process(target=target, args=args)
+	process.start()
+	process.join()
+	assert process.exitcode == 0
+
+
+def test_appends_are_not_lost_to_concurrent_rewrites(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file)
+	threads = [threading.Thread(target=append_records, args=(record_file, 100 + number * 50, 50)) for number in range(4)]
+	process = multiprocessing.Process(target=append_records, args=(record_file, 1000, 50))
+	process.start()
+	for thread in threads:
+		thread.start()
+	for number in range(10):
+		system.update_patient_record(f"{1000000 + number:07d}", 'BGT', UPDATE)
+	for thread in threads:
+		thread.join()
+	process.join()
+
+	lines = lines_of(record_file)
+	assert len(lines) == 20 + 4 * 50 + 50
+	assert sum(', 120, ' in line for line in lines) == 10
+	assert not [name for name in os.listdir(os.path.dirname(record_file)) if name.endswith('.tmp')]
+
+
+def test_rewrite_waits_for_the_lock(files):
+	test_file, record_file = files
+	storage = RecordFile(record_file)
+	started = threading.Event()
+	thread = threading.Thread(target=lambda: (started.set(), storage.rewrite([record_line(0)])))
+	with storage.lock:
+		thread.start()
+		started.wait()
+		thread.join(0.2)
+		assert thread.is_alive()
+		storage.append(record_line(99))
+		assert len(lines_of(record_file)) == 21
+	thread.join()
+	assert lines_of(record_file) == [record_line(0)]
+
+
+def test_journal_replays_and_compacts(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, journal=True)
+	system.update_patient_record('1000001', 'BGT', UPDATE)
+	system.delete_patient_record('1000002', 'BGT')
+	system.add_patient_record('7654321', 'LDL', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+	assert len(lines_of(record_file)) == 20
+	expected = sorted(str(record) for record in system.filter_tests())
+	assert len(expected) == 20
+	assert [record.result for record in system.filter_tests(patient_id='1000001')] == [120.0]
+
+	system.compact()
+	assert not os.path.exists(record_file + '.journal')
+	assert sorted(lines_of(record_file)) == expected
+
+
+def test_journal_compacts_in_the_background_once_full(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, journal=True)
+	system.journal.limit = 3
+	system.update_patient_record('1000001', 'BGT', UPDATE)
+	system.delete_patient_record('1000002', 'BGT')
+	assert system.journal.compactor is None
+	system.add_patient_record('7654321', 'LDL', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+	system.journal.compactor.join()
+
+	assert not os.path.exists(record_file + '.journal')
+	lines = lines_of(record_file)
+	assert len(lines) == 20
+	assert sum(', 120, ' in line for line in lines) == 1
+	assert not any(line.startswith('1000002: ') for line in lines)
+	assert [record.result for record in system.filter_tests(patient_id='7654321')] == [90.0]
+
+
+def test_journal_entries_from_another_process_are_replayed_and_compacted(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, journal=True)
+	system.update_patient_record('1000003', 'BGT', UPDATE)
+	run_process(journal_update, test_file, record_file, '1000004')
+
+	assert system.record_exists('7654321', 'LDL')
+	assert [record.result for record in system.filter_tests(patient_id='1000004')] == [120.0]
+	system.compact()
+	lines = lines_of(record_file)
+	assert len(lines) == 21
+	assert sum(', 120, ' in line for line in lines) == 2
+	assert any(line.startswith('7654321: LDL,') for line in lines)
+
+
+def test_index_follows_appends_and_rewrites_by_other_writers(files):
+	test_file, record_file = files
+	indexed = MedicalRecordSystem(test_file, record_file, indexed=True)
+	plain = MedicalRecordSystem(test_file, record_file)
+	assert not indexed.record_exists('7654321', 'LDL')
+
+	run_process(append_records, record_file, 6654321, 1)
+	assert indexed.record_exists('7654321', 'LDL')
+	assert len(indexed.filter_tests(test_name='LDL')) == 1
+
+	plain.delete_patient_record('1000005', 'BGT')
+	plain.update_patient_record('1000006', 'BGT', UPDATE)
+	assert not indexed.record_exists('1000005', 'BGT')
+	assert [record.result for record in indexed.filter_tests(patient_id='1000006', test_name='BGT')] == [120.0]
+	assert len(indexed.filter_tests(test_name='BGT')) == 19
+
+
+def test_snapshot_is_regenerated_when_the_records_change(files):
+	pytest.importorskip('numpy')
+	test_file, record_file = files
+	first = MedicalRecordSystem(test_file, record_file, snapshot=True)
+	assert len(first.filter_tests()) == 20
+	assert os.path.exists(record_file + '.snapshot')
+
+	run_process(append_records, record_file, 6654321, 1)
+	second = MedicalRecordSystem(test_file, record_file, snapshot=True)
+	assert len(second.filter_tests()) == 21
+	assert len(first.filter_tests()) == 21
+	assert first.summarize(test_name='LDL')['max_val'] == 80.0
+
+
+def test_resident_store_follows_other_writers(files):
+	test_file, record_file = files
+	resident = MedicalRecordSystem(test_file, record_file, in_memory=True)
+	other = MedicalRecordSystem(test_file, record_file)
+	assert not resident.record_exists('7654321', 'LDL')
+
+	other.add_patient_record('7654321', 'LDL', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+	other.delete_patient_record('1000001', 'BGT')
+	assert resident.record_exists('7654321', 'LDL')
+	assert not resident.filter_tests(patient_id='1000001')
+
+	resident.update_patient_record('1000002', 'BGT', UPDATE)
+	assert [record.result for record in resident.filter_tests(patient_id='1000002')] == [120.0]
+	assert len(resident.filter_tests()) == 20
+
+
+def test_partitions_leave_the_record_file_in_place(files):
+	test_file, record_file = files
+	partitioned = MedicalRecordSystem(test_file, record_file, partitioned=True)
+	menu = MedicalRecordSystem(test_file, record_file, indexed=True)
+	assert len(menu.filter_tests()) == 20
+
+	menu.add_patient_record('7654321', 'LDL', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+	march = (datetime.datetime(2024, 3, 1), datetime.datetime(2024, 3, 31, 23, 59, 59))
+	assert [record.patient_id for record in partitioned.filter_tests(start_date=march[0], end_date=march[1])] == \
+		['7654321']
+	partitioned.add_patient_record('7654322', 'LDL', '2024-03-02 08:00:00', '95', 'mg/dL', 'Pending')
+	assert menu.record_exists('7654322', 'LDL')
+	assert len(partitioned.filter_tests(start_date=march[0], end_date=march[1])) == 2
+
+
+def test_partitioned_storage_keeps_the_offset_index(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, partitioned=True, indexed=True)
+	assert system.storage.index is not None
+	system.add_patient_record('7654321', 'LDL', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+	system.delete_patient_record('1000003', 'BGT')
+	assert system.storage.index.stamp[0] == os.path.getsize(record_file)
+	assert [record.patient_id for record in system.filter_tests(test_name='LDL')] == ['7654321']
+	assert not system.record_exists('1000003', 'BGT')
+
+
+def test_partitioned_update_only_recuts_its_month(files):
+	test_file, record_file = files
+	with open(record_file, 'a') as file:
+		file.write("7654321: LDL, 2024-03-01 08:00:00, 90, mg/dL, Pending\n")
+	partitioned = MedicalRecordSystem(test_file, record_file, partitioned=True)
+	parts = os.path.join(os.path.dirname(record_file), 'medicalRecord.parts')
+	january = os.stat(os.path.join(parts, '2024-01.txt')).st_ino
+
+	partitioned.update_patient_record('7654321', 'LDL', dict(UPDATE, test_date='2024-03-05 08:00:00'))
+	assert os.stat(os.path.join(parts, '2024-01.txt')).st_ino == january
+	assert lines_of(os.path.join(parts, '2024-03.txt')) == [line for line in lines_of(record_file)
+	                                                       if line.startswith('7654321: ')]
+	partitioned.update_patient_record('7654321', 'LDL', dict(UPDATE, test_date='2024-04-05 08:00:00'))
+	assert not os.path.exists(os.path.join(parts, '2024-03.txt'))
+	assert len(lines_of(os.path.join(parts, '2024-04.txt'))) == 1
+
+
+@pytest.mark.parametrize('options', [{}, {'indexed': True}, {'partitioned': True}])
+def test_replace_without_a_patient_or_test_changes_nothing(files, options):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, **options)
+	before = os.stat(record_file)
+	assert not system.delete_patient_record('1000001', None)
+	assert not system.delete_patient_record(None, 'BGT')
+	assert not system.delete_patient_record(None, None)
+	assert not system.storage.replace('1000001', None, record_line(1, result='120'))
+	assert os.stat(record_file).st_ino == before.st_ino
+	assert len(lines_of(record_file)) == 20
+
+
+def test_replace_test_rewrites_the_definition_in_place(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file)
+	system.replace_test('BGT', '>60,<100', 'mg/dL', '00-10-00')
+	system.replace_test('HDL', '>40', 'mg/dL', '00-12-00')
+	assert lines_of(test_file) == ['BGT;>60,<100;mg/dL;00-10-00', 'LDL;<100;mg/dL;00-17-06', 'HDL;>40;mg/dL;00-12-00']
+	assert MedicalRecordSystem(test_file, record_file).tests['BGT'].bounds.lower == 60.0
+
+
+def test_interrupted_menu_edit_keeps_the_test(files, monkeypatch):
+	test_file, record_file = files
+	answers = iter(['4', 'BGT'])
+
+	def answer(prompt=''):
+		try:
+			return next(answers)
+		except StopIteration:
+			raise KeyboardInterrupt
+
+	monkeypatch.chdir(os.path.dirname(test_file))
+	monkeypatch.setattr('builtins.input', answer)
+	with pytest.raises(KeyboardInterrupt):
+		PPPPProject2.main()
+	assert lines_of(test_file) == ['BGT;>70,<99;mg/dL;00-12-06', 'LDL;<100;mg/dL;00-17-06']
+
+
+def test_index_is_searched_on_disk_and_merges_its_tail(files, monkeypatch):
+	test_file, record_file = files
+	with open(record_file, 'a') as file:
+		file.write("7654321: Vitamin D (25-OH), 2024-03-01 08:00:00, 30, ng/mL, Pending\n")
+	MedicalRecordSystem(test_file, record_file, indexed=True).record_exists('1000001', 'BGT')
+	index = RecordIndex(record_file)
+	assert index.files['patient'].tail == {} and index.files['patient'].block[2] == 21
+	assert index.candidates(test_name='Vitamin D (25-OH)') == [20 * len(record_line(0) + "\n")]
+
+	storage = RecordFile(record_file, indexed=True)
+	storage.append(record_line(5, 'LDL'))
+	assert RecordIndex(record_file).files['patient'].tail == {'1000005': [os.path.getsize(record_file) -
+	                                                                      len(record_line(5, 'LDL') + "\n")]}
+	assert [line for line in storage.read_lines(patient_id='1000005')] == [record_line(5), record_line(5, 'LDL')]
+	assert list(storage.read_lines(patient_id='1000099')) == []
+
+	monkeypatch.setattr(RecordIndex, 'TAIL_LIMIT', 2)
+	storage.append_many([record_line(30), record_line(31)])
+	reopened = RecordIndex(record_file)
+	assert reopened.files['test'].tail == {} and reopened.files['test'].block[2] == 24
+	assert len(list(storage.read_lines(test_name='BGT'))) == 22
+
+
+@pytest.mark.parametrize('backend', ['partitioned', 'database'])
+def test_journal_updates_move_records_across_date_ranges(files, tmp_path, backend):
+	test_file, record_file = files
+	options = {'partitioned': True} if backend == 'partitioned' else {'database': str(tmp_path / 'records.db')}
+	with open(record_file, 'a') as file:
+		file.write("7654321: LDL, 2020-01-05 08:00:00, 90, mg/dL, Pending\n")
+	if backend == 'database':
+		MedicalRecordSystem(test_file, record_file, **options).import_text(record_file, test_file)
+	system = MedicalRecordSystem(test_file, record_file, journal=True, **options)
+	system.update_patient_record('7654321', 'LDL', dict(UPDATE, test_date='2024-05-05 08:00:00'))
+
+	may = {'start_date': datetime.datetime(2024, 5, 1), 'end_date': datetime.datetime(2024, 5, 31)}
+	january = {'start_date': datetime.datetime(2020, 1, 1), 'end_date': datetime.datetime(2020, 1, 31)}
+	assert [record.patient_id for record in system.filter_tests(**may)] == ['7654321']
+	assert system.filter_tests(**january) == []
+
+
+@pytest.fixture
+def database(files, tmp_path):
+	test_file, record_file = files
+	mixed_records(record_file)
+	system = MedicalRecordSystem(test_file, record_file, database=str(tmp_path / 'records.db'))
+	counts = system.import_text(record_file, test_file)
+	assert counts == {'tests': 2, 'imported': 23, 'duplicates': 0, 'invalid': 0}
+	return system, MedicalRecordSystem(test_file, record_file)
+
+
+@pytest.mark.parametrize('criteria', CRITERIA)
+def test_sqlite_pushdown_matches_the_text_files(database, criteria):
+	sqlite, text = database
+	assert sqlite.filter_tests(**criteria) == text.filter_tests(**criteria)
+	assert sqlite.summarize(**criteria) == text.summarize(**criteria)
+
+
+def test_sqlite_updates_deletes_and_rewrites_like_the_text_files(database):
+	sqlite, text = database
+	for system in (sqlite, text):
+		system.update_patient_record('7654321', 'LDL', UPDATE)
+		assert system.delete_patient_record('1000004', 'BGT')
+		assert not system.delete_patient_record('1000004', 'BGT')
+	assert sqlite.filter_tests() == text.filter_tests()
+	assert sqlite.summarize(test_name='LDL') == text.summarize(test_name='LDL')
+
+	sqlite.storage.rewrite(line for line in text._read_lines() if not line.startswith('7654322: '))
+	assert len(sqlite.filter_tests()) == 21
+	assert not sqlite.record_exists('7654322', 'LDL')
+
+
+def test_sqlite_export_and_import_round_trip(database, tmp_path):
+	sqlite, text = database
+	assert sqlite.import_text(text.record_file, text.test_file) == \
+		{'tests': 0, 'imported': 0, 'duplicates': 23, 'invalid': 0}
+	exported = (str(tmp_path / 'exported.txt'), str(tmp_path / 'exportedTests.txt'))
+	sqlite.export_text(*exported)
+	assert lines_of(exported[0]) == lines_of(text.record_file)
+	assert lines_of(exported[1]) == lines_of(text.test_file)
+	assert MedicalRecordSystem(exported[1], exported[0]).filter_tests() == text.filter_tests()
@@ -0,0 +1,313 @@
+import datetime
+import os
+
+import pytest
+
+import PPPPProject2
+from conftest import CRITERIA, UPDATE, mixed_records, record_line
+from PPPPProject2 import MedicalRecordSystem, ReferenceRange
+
+
+def test_zero_bounds_are_compiled(files):
+	test_file, record_file = files
+	with open(test_file, 'a') as file:
+		file.write("Z;>0,<5;U/L;00-01-00\nN;<0;U/L;00-01-00\n")
+	system = MedicalRecordSystem(test_file, record_file)
+	assert system.is_abnormal('Z', ['0', '3', '5', '-1']) == [True, False, True, True]
+	assert system.is_abnormal('N', ['0', '-0.5']) == [True, False]
+	assert ReferenceRange.parse('>0,<5').lower == 0.0
+	assert ReferenceRange.parse('<0').is_abnormal(0.0)
+
+
+def test_parallel_scan_prefilters_each_chunk(files, monkeypatch):
+	test_file, record_file = files
+	with open(record_file, 'a') as file:
+		for number in range(20, 400):
+			file.write(record_line(number, 'LDL' if number % 3 else 'BGT', str(number % 150)) + "\n")
+	monkeypatch.setattr(PPPPProject2, 'PARALLEL_SCAN_MIN_BYTES', 4096)
+	serial = MedicalRecordSystem(test_file, record_file)
+	parallel = MedicalRecordSystem(test_file, record_file, workers=3)
+	assert parallel._use_parallel_scan() and not parallel._use_parallel_scan('1000001')
+	assert not MedicalRecordSystem(test_file, record_file, workers=3, indexed=True)._use_parallel_scan(None, 'LDL')
+
+	for criteria in ({'test_name': 'LDL', 'abnormal_only': True}, {'test_name': 'BGT'}, {'patient_id': '1000021'}):
+		assert parallel.filter_tests(**criteria) == serial.filter_tests(**criteria)
+	size = os.path.getsize(record_file)
+	chunks = [line for start in range(0, size, 1000)
+	          for line in PPPPProject2.chunk_lines(record_file, start, min(start + 1000, size), None, 'LDL')]
+	assert chunks == list(PPPPProject2.read_record_lines(record_file, test_name='LDL'))
+
+
+def test_running_aggregates_follow_other_writers(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, aggregates=True)
+	other = MedicalRecordSystem(test_file, record_file)
+	assert system.aggregates is None
+	assert system.summarize(test_name='BGT')['max_val'] == 80.0
+
+	system.add_patient_record('7654321', 'LDL', '2024-03-01 08:00:00', '99', 'mg/dL', 'Completed',
+	                          '2024-03-01 10:00:00')
+	aggregates = system.aggregates
+	assert system.summarize(test_name='LDL')['min_val'] == 99.0
+	assert system.aggregates is aggregates
+
+	other.add_patient_record('7654322', 'LDL', '2024-03-01 08:00:00', '10', 'mg/dL', 'Completed',
+	                         '2024-03-01 10:00:00')
+	assert system.summarize(test_name='LDL')['min_val'] == 10.0
+	other.update_patient_record('1000001', 'BGT', UPDATE)
+	system.delete_patient_record('1000002', 'BGT')
+	assert system.summarize(test_name='BGT') == MedicalRecordSystem(test_file, record_file).summarize(test_name='BGT')
+	assert system.summarize(test_name='BGT')['max_val'] == 120.0
+
+
+def test_validator_timing_survives_closing_another_instrumentation(files):
+	test_file, record_file = files
+	original = PPPPProject2.is_valid_date
+	first = MedicalRecordSystem(test_file, record_file, instrument=True)
+	second = MedicalRecordSystem(test_file, record_file, instrument=True)
+	PPPPProject2.is_valid_date('2024-01-01 08:00')
+	first.instrumentation.close()
+	PPPPProject2.is_valid_date('2024-01-01 08:00')
+	assert first.stats()['operations']['is_valid_date']['calls'] == 1
+	assert second.stats()['operations']['is_valid_date']['calls'] == 2
+
+	second.instrumentation.close()
+	second.instrumentation.close()
+	assert PPPPProject2.is_valid_date is original
+
+
+def test_distribution_leaves_pending_records_out_quietly(files, capsys):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file)
+	system.add_patient_record('7654321', 'BGT', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+	distribution = system.distribution()
+	assert capsys.readouterr().out == ''
+	assert distribution['BGT']['median_val'] == pytest.approx(80.0, rel=0.01)
+	assert sum(count for low, high, count in distribution['BGT']['histogram_val']) == 20
+
+
+@pytest.mark.parametrize('aggregates', [False, True])
+def test_group_summary_counts_every_record_quietly(files, capsys, aggregates):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, aggregates=aggregates)
+	system.add_patient_record('7654321', 'BGT', '2024-03-01 08:00:00', '90', 'mg/dL', 'Pending')
+	system.add_patient_record('7654322', 'LDL', '2024-03-02 08:00:00', '50', 'mg/dL', 'Pending')
+	by_test = {row['test_name']: row for row in system.group_summary('test_name')}
+	by_status = {row['status']: row for row in system.group_summary('status')}
+	by_month = {row['month']: row for row in system.group_summary('month')}
+	assert capsys.readouterr().out == ''
+
+	assert by_test['BGT']['count'] == 21 and by_test['BGT']['max_val'] == 80.0
+	assert by_test['LDL']['count'] == 1 and by_test['LDL']['min_val'] is None
+	assert by_status['pending']['count'] == 2 and by_status['completed']['count'] == 20
+	assert by_month['2024-03']['count'] == 2 and by_month['2024-01']['count'] == 20
+
+	system.delete_patient_record('7654322', 'LDL')
+	assert 'LDL' not in {row['test_name'] for row in system.group_summary('test_name')}
+
+
+@pytest.mark.parametrize('criteria', CRITERIA)
+def test_columnar_table_matches_the_scan(files, criteria):
+	pytest.importorskip('numpy')
+	test_file, record_file = files
+	mixed_records(record_file)
+	scan = MedicalRecordSystem(test_file, record_file)
+	columnar = MedicalRecordSystem(test_file, record_file, columnar=True)
+	assert columnar.filter_tests(**criteria) == scan.filter_tests(**criteria)
+	assert columnar.summarize(**criteria) == scan.summarize(**criteria)
+
+
+def test_columnar_table_masks_and_selects(files):
+	pytest.importorskip('numpy')
+	test_file, record_file = files
+	mixed_records(record_file)
+	system = MedicalRecordSystem(test_file, record_file)
+	records = system.filter_tests()
+	table = PPPPProject2.RecordTable(records)
+	assert len(table) == 23
+	mask = table.mask(test_name='BGT', abnormal_only=True, tests=system.tests)
+	assert table.select(mask) == [record for record in records if record.test_name == 'BGT' and record.result <= 70]
+	assert table.summary(table.mask(test_name='HDL'))['min_val'] is None
+	assert table.select(table.mask(status='pending')) == [records[21]]
+
+
+def test_snapshot_round_trips_the_table_and_catalogue(files, tmp_path):
+	pytest.importorskip('numpy')
+	test_file, record_file = files
+	mixed_records(record_file)
+	system = MedicalRecordSystem(test_file, record_file)
+	table = PPPPProject2.RecordTable(system.filter_tests())
+	snapshot = PPPPProject2.RecordSnapshot(str(tmp_path / 'records.snapshot'))
+	snapshot.save('source', system.tests, table)
+
+	assert snapshot.load('other source') is None
+	tests, loaded = snapshot.load('source')
+	assert [definition.to_line() for definition in tests.values()] == \
+		[definition.to_line() for definition in system.tests.values()]
+	for criteria in CRITERIA:
+		mask = loaded.mask(tests=tests, **criteria)
+		assert loaded.select(mask) == system.filter_tests(**criteria)
+		assert loaded.summary(mask) == system.summarize(**criteria)
+
+	with open(snapshot.path, 'r+b') as file:
+		file.write(b'BROKEN!!')
+	assert snapshot.load('source') is None
+	assert MedicalRecordSystem(test_file, record_file, snapshot=True).filter_tests() == system.filter_tests()
+
+
+def test_csv_import_skips_header_invalid_rows_and_duplicates(files, tmp_path, capsys):
+	test_file, record_file = files
+	csv_file = tmp_path / 'records.csv'
+	csv_file.write_text(
+		"patient_id,test_name,test_date,result,unit,status,result_date\n"
+		"7654321,LDL,2024-02-03 09:30:00,130.5,mg/dL,Reviewed,2024-02-04 10:00:00\n"
+		"7654321,BGT,2024-02-10 07:00,abc,mg/dL,Pending,\n"
+		"1000000,BGT,2024-01-02 08:00:00,90,mg/dL,Completed,2024-01-02 09:00:00\n"
+		"7654321,BGT,2024-02-10 07:00:00,65,mg/dL,Pending,\n"
+		"7654321,LDL,2024-02-05 09:30:00,99,mg/dL,Pending\n"
+		"7654322,LDL\n")
+	system = MedicalRecordSystem(test_file, record_file)
+	counts = system.import_csv(str(csv_file), batch_size=2)
+	assert counts == {'imported': 2, 'duplicates': 2, 'invalid': 2}
+	out = capsys.readouterr().out
+	assert "Skipping row 3" in out and "Skipping row 7" in out and "row 1:" not in out
+	assert system.filter_tests(patient_id='7654321') == \
+		[PPPPProject2.PatientRecord.parse("7654321: LDL, 2024-02-03 09:30:00, 130.5, mg/dL, Reviewed, 2024-02-04 10:00:00"),
+		 PPPPProject2.PatientRecord.parse("7654321: BGT, 2024-02-10 07:00:00, 65, mg/dL, Pending")]
+	assert system.filter_tests(patient_id='1000000')[0].result == 80.0
+
+
+def test_csv_export_imports_back_unchanged(files, tmp_path):
+	test_file, record_file = files
+	mixed_records(record_file)
+	system = MedicalRecordSystem(test_file, record_file)
+	csv_file = str(tmp_path / 'records.csv')
+	assert system.export_csv(csv_file) == 23
+	assert system.export_csv(str(tmp_path / 'ldl.csv'), test_name='LDL') == 2
+
+	empty = tmp_path / 'empty.txt'
+	empty.write_text('')
+	restored = MedicalRecordSystem(test_file, str(empty))
+	assert restored.import_csv(csv_file) == {'imported': 23, 'duplicates': 0, 'invalid': 0}
+	assert restored.filter_tests() == system.filter_tests()
+	assert restored.import_csv(csv_file) == {'imported': 0, 'duplicates': 23, 'invalid': 0}
+
+
+@pytest.mark.parametrize('options', [{}, {'in_memory': True}, {'snapshot': True}])
+def test_records_keep_the_result_as_written(files, options):
+	test_file, record_file = files
+	with open(record_file, 'a') as file:
+		file.write("7654321: LDL, 2024-02-03 09:30:00, 10.0, mg/dL, Reviewed, 2024-02-04 10:00:00\n")
+		file.write("7654321: BGT, 2024-02-10 07:00:00, 65.50, mg/dL, Pending\n")
+	MedicalRecordSystem(test_file, record_file, **options)
+	system = MedicalRecordSystem(test_file, record_file, **options)
+	assert [str(record) for record in system.filter_tests(patient_id='7654321')] == \
+		["7654321: LDL, 2024-02-03 09:30:00, 10.0, mg/dL, Reviewed, 2024-02-04 10:00:00",
+		 "7654321: BGT, 2024-02-10 07:00:00, 65.50, mg/dL, Pending"]
+	record = system.filter_tests(patient_id='7654321', test_name='LDL')[0]
+	assert record.result == 10.0 and record.formatted_result == '10.0'
+
+
+def test_timeline_cache_evicts_least_recently_used(files):
+	records = [PPPPProject2.PatientRecord.parse(record_line(number)) for number in range(3)]
+	cache = PPPPProject2.PatientTimelineCache(max_patients=2)
+	assert cache.get('a', 'v1') is None
+	cache.put('a', records[:1])
+	cache.put('b', records[1:2])
+	assert cache.get('a', 'v1') == records[:1]
+	cache.put('c', records[2:])
+	assert cache.get('b', 'v1') is None and cache.get('a', 'v1') == records[:1]
+	assert cache.stats() == {'hits': 2, 'misses': 2, 'patients': 2, 'bytes': cache.bytes}
+	assert cache.get('a', 'v2') is None and cache.stats()['patients'] == 0 and cache.bytes == 0
+
+	size = cache.estimate_size(records[:1])
+	cache = PPPPProject2.PatientTimelineCache(max_patients=10, max_bytes=size * 2 + 1)
+	for patient_id in 'abc':
+		cache.put(patient_id, records[:1])
+	assert list(cache.timelines) == ['b', 'c'] and cache.bytes == size * 2
+	cache.put('d', records)
+	assert 'd' not in cache.timelines and list(cache.timelines) == ['b', 'c']
+
+
+def test_timeline_cache_follows_writes(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, cache_size=10)
+	assert len(system.patient_timeline('1000001')) == 1
+	assert len(system.patient_timeline('1000002')) == 1
+	assert system.cache.stats()['misses'] == 2
+
+	system.add_patient_record('1000001', 'LDL', '2023-12-01 08:00:00', '70', 'mg/dL', 'Pending')
+	timeline = system.patient_timeline('1000001')
+	assert [record.test_name for record in timeline] == ['LDL', 'BGT']
+	system.update_patient_record('1000001', 'LDL', UPDATE)
+	assert [record.result for record in system.patient_timeline('1000001')] == [80.0, 120.0]
+	system.patient_timeline('1000002')
+	assert system.cache.stats()['hits'] == 1 and system.cache.stats()['misses'] == 4
+
+
+def test_timeline_cache_drops_everything_on_outside_changes(files):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, cache_size=10)
+	system.patient_timeline('1000001')
+	system.patient_timeline('1000002')
+
+	stat = os.stat(record_file)
+	os.utime(record_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+	assert len(system.patient_timeline('1000001')) == 1
+	assert system.cache.stats() == {'hits': 0, 'misses': 3, 'patients': 1, 'bytes': system.cache.bytes}
+
+	MedicalRecordSystem(test_file, record_file).add_patient_record(
+		'1000001', 'LDL', '2024-03-01 08:00:00', '70', 'mg/dL', 'Pending')
+	assert len(system.patient_timeline('1000001')) == 2
+	assert system.cache.stats()['misses'] == 4
+
+
+@pytest.mark.parametrize('criteria', [{'patient_id': '1000001', 'test_name': 'BGT'}, {'status': 'completed'},
+                                      {'abnormal_only': True},
+                                      {'test_name': 'BGT', 'end_date': datetime.datetime(2024, 2, 1)},
+                                      {'start_date': datetime.datetime(2024, 1, 1, 9)}])
+def test_summaries_the_aggregates_cannot_answer_leave_them_unbuilt(files, criteria):
+	test_file, record_file = files
+	system = MedicalRecordSystem(test_file, record_file, aggregates=True)
+	assert system.summarize(**criteria) == MedicalRecordSystem(test_file, record_file).summarize(**criteria)
+	assert system.aggregates is None
+	system.summarize(start_date=datetime.datetime(2024, 1, 1))
+	assert system.aggregates is not None
+
+
+def test_validator_reports_the_first_failing_check_of_each_row(files):
+	test_file, record_file = files
+	validator = MedicalRecordSystem(test_file, record_file).get_validator()
+	Validator = PPPPProject2.RecordValidator
+	valid = ['7654321', 'LDL', '2024-02-03 09:30', '130.5', 'mg/dL', 'Reviewed', '2024-02-04 10:00:00']
+	cases = [
+		(valid, Validator.OK),
+		(valid[:6] + [' '], Validator.OK),
+		(valid[:5], Validator.BAD_COLUMNS),
+		(valid + ['extra'], Validator.BAD_COLUMNS),
+		(['765432'] + valid[1:], Validator.BAD_PATIENT_ID),
+		(valid[:1] + ['XYZ'] + valid[2:], Validator.UNKNOWN_TEST),
+		(valid[:2] + ['2024-02-30 09:30'] + valid[3:], Validator.BAD_TEST_DATE),
+		(valid[:3] + ['1e3'] + valid[4:], Validator.BAD_RESULT),
+		(valid[:4] + ['mmol/L'] + valid[5:], Validator.BAD_UNIT),
+		(valid[:5] + ['done'] + valid[6:], Validator.BAD_STATUS),
+		(valid[:6] + ['2024-02-04'], Validator.BAD_RESULT_DATE),
+		(valid[:6] + ['2024-02-03 09:30'], Validator.RESULT_BEFORE_TEST),
+		# Precedence follows the columns: patient ID, test, test date, result, unit, status, result date
+		(['x', 'XYZ', 'bad', 'bad', 'bad', 'bad', 'bad'], Validator.BAD_PATIENT_ID),
+		(['7654321', 'XYZ', 'bad', 'bad', 'bad', 'bad', 'bad'], Validator.UNKNOWN_TEST),
+		(valid[:2] + ['bad', 'bad', 'bad', 'bad', 'bad'], Validator.BAD_TEST_DATE),
+		(valid[:3] + ['bad', 'bad', 'bad', '2024-01-01 00:00'], Validator.BAD_RESULT),
+		(valid[:4] + ['bad', 'bad', 'bad'], Validator.BAD_UNIT),
+		(valid[:5] + ['bad', '2024-01-01 00:00'], Validator.BAD_STATUS),
+	]
+	rows = [list(row) for row, code in cases]
+	assert validator.validate_rows(rows) == [code for row, code in cases]
+	assert rows[1] == valid[:6]
+	assert validator.message(Validator.UNKNOWN_TEST, rows[5]) == "test XYZ does not exist"
+	assert validator.message(Validator.OK, rows[0]) is None
+
+	columns = [list(column) for column in zip(*(row[:6] for row, code in cases[4:12]))]
+	result_dates = [row[6] if len(row) > 6 else None for row, code in cases[4:12]]
+	assert validator.validate_columns(*columns, result_dates) == [code for row, code in cases[4:12]]
+	assert validator.validate_columns(*columns) == [code for row, code in cases[4:10]] + [Validator.OK] * 2